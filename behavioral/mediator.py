@@ -2,9 +2,19 @@
 Mediator (Middleware) lets you reduce chaotic dependencies between objects. The pattern restricts
 direct communications between the objects and forces them to collaborate only via a mediator object.
 """
+import asyncio
+import operator
+import queue
+import threading
+import time
+import tracemalloc
 from abc import ABC, abstractmethod
+from collections import defaultdict, deque
 from dataclasses import dataclass
-from typing import Any, List
+from itertools import repeat
+from typing import Any, Callable, DefaultDict, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+Message = Tuple[str, str]
 
 
 @dataclass
@@ -14,9 +24,12 @@ class Event:
 
 
 class Participant(ABC):
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, role: str = "member") -> None:
         self._name = name
+        self.role = role
         self._room = None
+        # (sender name, message) delivered by the room
+        self.mailbox: Deque[Message] = deque()
 
     @property
     def room(self) -> "ChatRoom":
@@ -36,6 +49,9 @@ class Participant(ABC):
     def send_message(self, message: str) -> None:
         self.room.notify(self, Event("message", message))
 
+    def receive(self, sender: str, message: str) -> None:
+        self.mailbox.append((sender, message))
+
 
 class User(Participant):
     ...
@@ -44,8 +60,12 @@ class User(Participant):
 class Bot(Participant):
 
     def greetings_all(self) -> None:
-        for user in self.room.get_users(self):
-            self.send_message(f"Welcome {user.name}!")
+        # every greeting goes to its user only, not to the whole room
+        self.room.notify(self, Event("greet"))
+
+
+def participant_types(participant: Participant) -> List[type]:
+    return [cls for cls in type(participant).__mro__ if issubclass(cls, Participant)]
 
 
 class Mediator(ABC):
@@ -57,28 +77,304 @@ class Mediator(ABC):
 
 class ChatRoom(Mediator):
 
-    def __init__(self) -> None:
+    def __init__(self, verbose: bool = True) -> None:
         self._participants = {}
+        self.verbose = verbose
+        # indexes kept up to date on add/remove, so lookups don't scan the whole room
+        self._by_type: DefaultDict[type, Dict[str, Participant]] = defaultdict(dict)
+        self._by_role: DefaultDict[str, Dict[str, Participant]] = defaultdict(dict)
+        self._receivers: Dict[str, Callable[[Message], None]] = {}
 
     def add_participant(self, participant: Participant) -> None:
+        if participant.name in self._participants:
+            self.remove_participant(self._participants[participant.name])
         self._participants[participant.name] = participant
+        for cls in participant_types(participant):
+            self._by_type[cls][participant.name] = participant
+        self._by_role[participant.role][participant.name] = participant
+        if type(participant).receive is Participant.receive:
+            # default delivery is a plain append, broadcast calls it without a Python frame per user
+            self._receivers[participant.name] = participant.mailbox.append
+        else:
+            self._receivers[participant.name] = lambda message, receive=participant.receive: receive(*message)
         participant.room = self
 
     def remove_participant(self, participant: Participant) -> None:
+        if self._participants.get(participant.name) is not participant:
+            # already left (or replaced by a namesake)
+            return
         del self._participants[participant.name]
+        for cls in participant_types(participant):
+            self._by_type[cls].pop(participant.name, None)
+        self._by_role[participant.role].pop(participant.name, None)
+        del self._receivers[participant.name]
+
+    def broadcast(self, sender: Participant, message: str) -> None:
+        """Deliver the message to everyone in the room except the sender."""
+        receivers = self._receivers.copy()
+        receivers.pop(sender.name, None)
+        # the message tuple is built once and shared by all mailboxes
+        deque(map(operator.call, receivers.values(), repeat((sender.name, message))), maxlen=0)
+
+    def greet(self, sender: Participant) -> None:
+        """Deliver "Welcome <name>!" from the sender to each user, in one pass over the index."""
+        names = [user.name for user in self.get_users(sender)]
+        greetings = [(sender.name, f"Welcome {name}!") for name in names]
+        if self.verbose:
+            print("\n".join(f"{sender.name}::{message}" for _, message in greetings))
+        deque(map(operator.call, map(self._receivers.__getitem__, names), greetings), maxlen=0)
 
     def notify(self, participant: Participant, event: Event) -> None:
+        self.handle(participant, event)
+
+    def handle(self, participant: Participant, event: Event) -> None:
         match event.type:
             case "message":
-                print(f"{participant.name}::{event.context}")
+                if self.verbose:
+                    print(f"{participant.name}::{event.context}")
+                self.broadcast(participant, event.context)
+            case "greet":
+                self.greet(participant)
             case "leave":
-                print(f"{participant.name} left the room!")
+                if self.verbose:
+                    print(f"{participant.name} left the room!")
                 self.remove_participant(participant)
 
     def get_users(self, sender: Participant) -> List[Participant]:
         if not isinstance(sender, Bot):
             return []
-        return list(filter(lambda p: isinstance(p, User), self._participants.values()))
+        return list(self._by_type[User].values())
+
+    def get_participants(self, role: str) -> List[Participant]:
+        return list(self._by_role[role].values())
+
+
+class HubRoom(ChatRoom):
+    """Room of a ChatHub, its events are queued to the shard that owns the room."""
+
+    def __init__(self, hub: "ChatHub", room_id: Hashable) -> None:
+        super().__init__(verbose=False)
+        self.hub = hub
+        self.room_id = room_id
+
+    def notify(self, participant: Participant, event: Event) -> None:
+        self.hub.submit(self, participant, event)
+
+
+def print_error(room: HubRoom, event: Event, exc: Exception) -> None:
+    print(f"Room {room.room_id!r} failed to handle {event.type!r}: {exc!r}")
+
+
+class ChatHub:
+    """
+    Shards rooms between worker threads. Every room always lands on the same shard, which handles
+    its events one by one in the order they came, so ordering is kept per room.
+    """
+
+    def __init__(
+        self, shards: int = 4, on_error: Callable[[HubRoom, Event, Exception], None] = print_error
+    ) -> None:
+        self.on_error = on_error
+        self._queues: List[queue.Queue] = [queue.Queue() for _ in range(shards)]
+        self._rooms: Dict[Hashable, HubRoom] = {}
+        self._rooms_lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._run, args=(inbound,), daemon=True) for inbound in self._queues
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def room(self, room_id: Hashable) -> HubRoom:
+        room = self._rooms.get(room_id)
+        if room is None:
+            with self._rooms_lock:
+                room = self._rooms.get(room_id)
+                if room is None:
+                    room = self._rooms[room_id] = HubRoom(self, room_id)
+        return room
+
+    def submit(self, room: HubRoom, participant: Participant, event: Event) -> None:
+        self._queues[hash(room.room_id) % len(self._queues)].put((room, participant, event))
+
+    def flush(self) -> None:
+        """Wait until every submitted event is handled."""
+        for inbound in self._queues:
+            inbound.join()
+
+    def close(self) -> None:
+        for inbound in self._queues:
+            inbound.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self, inbound: queue.Queue) -> None:
+        while True:
+            item = inbound.get()
+            try:
+                if item is None:
+                    return
+                room, participant, event = item
+                try:
+                    room.handle(participant, event)
+                except Exception as exc:
+                    # one bad event must not kill the shard, its queue would never be drained again
+                    self.on_error(room, event, exc)
+            finally:
+                inbound.task_done()
+
+
+class AsyncParticipant:
+
+    def __init__(self, name: str, mailbox_size: int = 100) -> None:
+        self.name = name
+        self.room: Optional["AsyncChatRoom"] = None
+        self.mailbox: asyncio.Queue[Message] = asyncio.Queue(mailbox_size)
+        self.dropped = 0
+        self.disconnected = False
+
+    async def send_message(self, message: str) -> None:
+        if self.room is None:
+            raise RuntimeError(f"{self.name} is not in a room")
+        await self.room.notify(self, Event("message", message))
+
+    async def leave_room(self, drain: bool = False) -> None:
+        """Leave the room, deliveries still waiting for space are awaited with ``drain`` or cancelled."""
+        if self.room is None:
+            # already left or disconnected
+            return
+        await self.room.notify(self, Event("leave", "drain" if drain else None))
+
+    async def receive(self) -> Message:
+        return await self.mailbox.get()
+
+
+class AsyncChatRoom(Mediator):
+    """
+    Asyncio room with bounded participant mailboxes. When a mailbox is full the message is dropped,
+    the slow participant is disconnected, or the sender waits for space, depending on ``overflow``.
+    """
+    DROP = "drop"
+    DISCONNECT = "disconnect"
+    BLOCK = "block"
+
+    def __init__(self, overflow: str = DROP) -> None:
+        if overflow not in (self.DROP, self.DISCONNECT, self.BLOCK):
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+        self.overflow = overflow
+        self._participants: Dict[str, AsyncParticipant] = {}
+        # deliveries blocked on full mailboxes, by recipient
+        self._pending: DefaultDict[str, Set[asyncio.Task]] = defaultdict(set)
+
+    def add_participant(self, participant: AsyncParticipant) -> None:
+        self._participants[participant.name] = participant
+        participant.room = self
+        participant.disconnected = False
+
+    def remove_participant(self, participant: AsyncParticipant) -> None:
+        if self._participants.get(participant.name) is participant:
+            del self._participants[participant.name]
+        if participant.room is self:
+            participant.room = None
+
+    async def notify(self, participant: AsyncParticipant, event: Event) -> None:
+        match event.type:
+            case "message":
+                await self._deliver(participant, (participant.name, event.context))
+            case "leave":
+                self.remove_participant(participant)
+                pending = self._pending.pop(participant.name, set())
+                if event.context != "drain":
+                    for task in pending:
+                        task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _deliver(self, sender: AsyncParticipant, message: Message) -> None:
+        blocked = []
+        for recipient in list(self._participants.values()):
+            if recipient is sender:
+                continue
+            try:
+                recipient.mailbox.put_nowait(message)
+            except asyncio.QueueFull:
+                if self.overflow == self.DROP:
+                    recipient.dropped += 1
+                elif self.overflow == self.DISCONNECT:
+                    recipient.disconnected = True
+                    self.remove_participant(recipient)
+                else:
+                    blocked.append(self._put_later(recipient, message))
+        if blocked:
+            # a cancelled delivery (the recipient left) shouldn't fail the sender
+            await asyncio.gather(*blocked, return_exceptions=True)
+
+    def _put_later(self, recipient: AsyncParticipant, message: Message) -> asyncio.Task:
+        task = asyncio.create_task(recipient.mailbox.put(message))
+        pending = self._pending[recipient.name]
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        return task
+
+
+async def async_benchmark(rooms: int = 1000, participants: int = 100) -> None:
+    tracemalloc.start()
+    started = time.perf_counter()
+    chat_rooms = [AsyncChatRoom() for _ in range(rooms)]
+    senders = []
+    for room in chat_rooms:
+        for idx in range(participants):
+            room.add_participant(AsyncParticipant(f"user{idx}", mailbox_size=16))
+        senders.append(next(iter(room._participants.values())))
+    await asyncio.gather(*(sender.send_message("hello") for sender in senders))
+    elapsed = time.perf_counter() - started
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{rooms * participants:,} async participants: {elapsed:.2f}s, "
+          f"{memory / rooms / participants:.0f} bytes per participant")
+
+
+async def async_main() -> None:
+    room = AsyncChatRoom(overflow=AsyncChatRoom.DROP)
+    alice, slow = AsyncParticipant("Alice"), AsyncParticipant("Slow", mailbox_size=2)
+    room.add_participant(alice)
+    room.add_participant(slow)
+    for idx in range(5):
+        await alice.send_message(f"message {idx}")
+    print(f"Slow got {slow.mailbox.qsize()} messages, dropped {slow.dropped}")
+
+    room = AsyncChatRoom(overflow=AsyncChatRoom.BLOCK)
+    bob, carl = AsyncParticipant("Bob"), AsyncParticipant("Carl", mailbox_size=1)
+    room.add_participant(bob)
+    room.add_participant(carl)
+    await bob.send_message("first")
+    # Carl's mailbox is full, the sender waits until Carl leaves and the delivery is cancelled
+    sending = asyncio.create_task(bob.send_message("second"))
+    await asyncio.sleep(0)
+    await carl.leave_room()
+    await sending
+    print(f"Carl left with {carl.mailbox.qsize()} message in the mailbox")
+
+    await async_benchmark()
+
+
+def benchmark(rooms: int = 200, participants: int = 10, messages: int = 20) -> None:
+    for shards in (1, 2, 4, 8):
+        hub = ChatHub(shards)
+        users: List[Participant] = []
+        for room_id in range(rooms):
+            room = hub.room(room_id)
+            for idx in range(participants):
+                user = User(f"user{idx}")
+                room.add_participant(user)
+                users.append(user)
+
+        started = time.perf_counter()
+        for idx in range(messages):
+            for user in users:
+                user.send_message(f"message {idx}")
+        hub.flush()
+        elapsed = time.perf_counter() - started
+        hub.close()
+        print(f"{shards} shards: {len(users) * messages / elapsed:,.0f} messages/s")
 
 
 def main():
@@ -96,6 +392,26 @@ def main():
     ai_bot.greetings_all()
 
     bob.leave_room()
+    print(f"Alex's mailbox: {list(alex.mailbox)}")
+
+    room.add_participant(User("Moderator", role="moderator"))
+    print(f"Moderators: {[p.name for p in room.get_participants('moderator')]}")
+    ai_bot.room.broadcast(ai_bot, "Maintenance at midnight")
+    print(f"Alex's last message: {alex.mailbox[-1]}")
+
+    hub = ChatHub(shards=2)
+    ann, tom = User("Ann"), User("Tom")
+    hub.room("general").add_participant(ann)
+    hub.room("general").add_participant(tom)
+    hub.room("random").add_participant(User("Kate"))
+    ann.send_message("first")
+    ann.send_message("second")
+    hub.flush()
+    hub.close()
+    print(f"Tom's mailbox: {list(tom.mailbox)}")
+    benchmark()
+
+    asyncio.run(async_main())
 
 
 if __name__ == "__main__":
@@ -2,13 +2,24 @@
 Memento lets you save and restore the previous state of an object without revealing the details of
 its implementation.
 """
+import lzma
+import mmap
+import os
 import string
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
 from abc import abstractmethod, ABC
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
 import random
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
 
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+NAME_LENGTH = 40
 
 
 def generate_random_string(num: int = 10) -> str:
@@ -33,16 +44,20 @@ class Memento(ABC):
 
 class Snapshot(Memento):
 
-    def __init__(self, state: State) -> None:
+    def __init__(self, state: State, created: Optional[datetime] = None) -> None:
         self._state = state
-        self._created = datetime.now()
+        self._created = datetime.now() if created is None else created
 
     @property
     def state(self) -> State:
         return self._state
 
+    @property
+    def created(self) -> datetime:
+        return self._created
+
     def get_name(self) -> str:
-        return self._state.text
+        return self._state.text[:NAME_LENGTH]
 
     def get_datetime(self) -> str:
         return self._created.strftime(DATETIME_FORMAT)
@@ -64,15 +79,342 @@ class Editor:
         self._state = momento.state
 
 
+class History(ABC):
+    """Storage of saved snapshots, the most recent one is popped first."""
+
+    @abstractmethod
+    def push(self, snapshot: Snapshot) -> None:
+        ...
+
+    @abstractmethod
+    def pop(self) -> Snapshot:
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def entries(self) -> Iterator[Memento]:
+        """Metadata of the saved snapshots, oldest first."""
+
+    def close(self) -> None:
+        """Release the resources held by the history, nothing to do for the in-memory ones."""
+
+    def __enter__(self) -> "History":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+class ListHistory(History):
+
+    def __init__(self) -> None:
+        self._snapshots: List[Snapshot] = []
+
+    def push(self, snapshot: Snapshot) -> None:
+        self._snapshots.append(snapshot)
+
+    def pop(self) -> Snapshot:
+        return self._snapshots.pop()
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def entries(self) -> Iterator[Memento]:
+        return iter(list(self._snapshots))
+
+
+def common_prefix(a: str, b: str, limit: int, reverse: bool = False) -> int:
+    """
+    Length of the common prefix (or suffix) of two strings up to ``limit``. Chunks of growing size
+    are compared as slices, so characters are compared in C rather than one by one.
+    """
+    def chunk(text: str, start: int, stop: int) -> str:
+        return text[len(text) - stop:len(text) - start] if reverse else text[start:stop]
+
+    lo, step = 0, 64
+    while lo < limit:
+        hi = min(lo + step, limit)
+        if chunk(a, lo, hi) != chunk(b, lo, hi):
+            break
+        lo, step = hi, step * 2
+    else:
+        return limit
+    # the first difference is somewhere in [lo, hi)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if chunk(a, lo, mid) == chunk(b, lo, mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+@dataclass(frozen=True)
+class Delta:
+    """new == old[:start] + inserted + old[start + len(removed):], and the other way around."""
+    start: int
+    removed: str
+    inserted: str
+
+    @classmethod
+    def between(cls, old: str, new: str) -> "Delta":
+        limit = min(len(old), len(new))
+        prefix = common_prefix(old, new, limit)
+        suffix = common_prefix(old, new, limit - prefix, reverse=True)
+        return cls(prefix, old[prefix:len(old) - suffix], new[prefix:len(new) - suffix])
+
+    def apply(self, old: str) -> str:
+        return old[:self.start] + self.inserted + old[self.start + len(self.removed):]
+
+    def revert(self, new: str) -> str:
+        return new[:self.start] + self.removed + new[self.start + len(self.inserted):]
+
+    @property
+    def size(self) -> int:
+        return len(self.removed) + len(self.inserted)
+
+
+class HistoryEntry(Memento):
+
+    def __init__(self, name: str, created: datetime, keyframe: Optional[str], delta: Optional[Delta]) -> None:
+        self.name = name
+        self.created = created
+        # either the whole text or the difference from the previous entry
+        self.keyframe = keyframe
+        self.delta = delta
+
+    @property
+    def size(self) -> int:
+        return len(self.keyframe) if self.keyframe is not None else self.delta.size
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get_datetime(self) -> str:
+        return self.created.strftime(DATETIME_FORMAT)
+
+
+class DeltaHistory(History):
+    """
+    Stores the whole text every ``keyframe_interval`` saves and only differences in between.
+    The latest text is kept, so undo reverts one delta at a time. When ``max_entries`` or
+    ``max_size`` (in characters) is exceeded, the oldest entries are dropped and the next one
+    becomes a keyframe.
+    """
+
+    def __init__(
+        self, keyframe_interval: int = 100, max_entries: Optional[int] = None, max_size: Optional[int] = None
+    ) -> None:
+        self._keyframe_interval = keyframe_interval
+        self._max_entries = max_entries
+        self._max_size = max_size
+        # deque, the oldest entries are evicted from the left in O(1)
+        self._entries: Deque[HistoryEntry] = deque()
+        self._since_keyframe = 0
+        self._size = 0
+        # text of the most recent entry
+        self._tip: Optional[str] = None
+
+    def push(self, snapshot: Snapshot) -> None:
+        text = snapshot.state.text
+        if self._tip is None or self._since_keyframe + 1 >= self._keyframe_interval:
+            entry = HistoryEntry(snapshot.get_name(), snapshot.created, text, None)
+            self._since_keyframe = 0
+        else:
+            entry = HistoryEntry(snapshot.get_name(), snapshot.created, None, Delta.between(self._tip, text))
+            self._since_keyframe += 1
+        self._entries.append(entry)
+        self._size += entry.size
+        self._tip = text
+        self._enforce_limits()
+
+    def pop(self) -> Snapshot:
+        entry = self._entries.pop()
+        self._size -= entry.size
+        text = self._tip
+        if entry.delta is not None:
+            self._tip = entry.delta.revert(text)
+            self._since_keyframe -= 1
+        else:
+            # the previous entry has to be rebuilt from its keyframe
+            self._tip = self._text_at(len(self._entries) - 1) if self._entries else None
+            self._since_keyframe = self._deltas_since_keyframe()
+        return Snapshot(State(text), entry.created)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def entries(self) -> Iterator[Memento]:
+        return iter(list(self._entries))
+
+    def _text_at(self, index: int) -> str:
+        # walk back to the keyframe, deque indexing is cheap near the end where undo happens
+        deltas = []
+        while (entry := self._entries[index]).keyframe is None:
+            deltas.append(entry.delta)
+            index -= 1
+        text = entry.keyframe
+        for delta in reversed(deltas):
+            text = delta.apply(text)
+        return text
+
+    def _deltas_since_keyframe(self) -> int:
+        count = 0
+        for entry in reversed(self._entries):
+            if entry.keyframe is not None:
+                break
+            count += 1
+        return count
+
+    def _enforce_limits(self) -> None:
+        while len(self._entries) > 1 and (
+            (self._max_entries is not None and len(self._entries) > self._max_entries)
+            or (self._max_size is not None and self._size > self._max_size)
+        ):
+            oldest = self._entries.popleft()
+            self._size -= oldest.size
+            following = self._entries[0]
+            if following.keyframe is None:
+                # compaction, the next entry can't be restored without the dropped one
+                self._size -= following.size
+                following.keyframe = following.delta.apply(oldest.keyframe)
+                following.delta = None
+                self._size += following.size
+                # it may have become the latest keyframe, then only the entries after it are deltas
+                self._since_keyframe = min(self._since_keyframe, len(self._entries) - 1)
+
+
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+class SegmentEntry(Memento):
+    """Index record of a snapshot spilled to the segment file, the payload stays on disk."""
+
+    def __init__(self, name: str, created: datetime, offset: int, length: int) -> None:
+        self.name = name
+        self.created = created
+        self.offset = offset
+        self.length = length
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get_datetime(self) -> str:
+        return self.created.strftime(DATETIME_FORMAT)
+
+
+class SpillingHistory(History):
+    """
+    Keeps the ``memory_entries`` most recent snapshots in memory. Older ones are compressed and
+    appended to a segment file, an in-memory index keeps their offsets and metadata. Spilled
+    snapshots are read back through ``mmap`` only when they are undone. Without a ``path`` a
+    temporary file is used and removed by ``close()``, an existing file is never overwritten.
+    """
+
+    def __init__(self, path: Optional[str] = None, memory_entries: int = 16, codec: str = "zlib") -> None:
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec!r}, expected one of {list(CODECS)}")
+        self._compress, self._decompress = CODECS[codec]
+        self._memory_entries = memory_entries
+        self._recent: Deque[Snapshot] = deque()
+        self._index: List[SegmentEntry] = []
+        self._temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".history")
+            self._file = os.fdopen(fd, "w+b")
+        else:
+            # raises FileExistsError instead of truncating somebody's file
+            self._file = open(path, "x+b")
+        self._path = path
+        self._mapping: Optional[mmap.mmap] = None
+
+    def push(self, snapshot: Snapshot) -> None:
+        self._recent.append(snapshot)
+        if len(self._recent) > self._memory_entries:
+            self._spill(self._recent.popleft())
+
+    def pop(self) -> Snapshot:
+        if self._recent:
+            return self._recent.pop()
+        entry = self._index.pop()
+        payload = self._read(entry.offset, entry.length)
+        # the popped record is the last one, give its space back
+        self._unmap()
+        self._file.truncate(entry.offset)
+        return Snapshot(State(self._decompress(payload).decode()), entry.created)
+
+    def __len__(self) -> int:
+        return len(self._index) + len(self._recent)
+
+    @property
+    def spilled(self) -> int:
+        return len(self._index)
+
+    @property
+    def disk_size(self) -> int:
+        return self._index[-1].offset + self._index[-1].length if self._index else 0
+
+    def entries(self) -> Iterator[Memento]:
+        # metadata only, nothing is decompressed
+        yield from list(self._index)
+        yield from list(self._recent)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._unmap()
+        self._file.close()
+        if self._temporary:
+            os.remove(self._path)
+
+    def _spill(self, snapshot: Snapshot) -> None:
+        payload = self._compress(snapshot.state.text.encode())
+        offset = self.disk_size
+        self._file.seek(offset)
+        self._file.write(payload)
+        self._file.flush()
+        self._index.append(SegmentEntry(snapshot.get_name(), snapshot.created, offset, len(payload)))
+
+    def _read(self, offset: int, length: int) -> bytes:
+        if self._mapping is None or len(self._mapping) < offset + length:
+            self._unmap()
+            self._mapping = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mapping[offset:offset + length]
+
+    def _unmap(self) -> None:
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+
 class Application:
 
-    def __init__(self, editor: Editor) -> None:
-        self._history = []
+    def __init__(self, editor: Editor, history: Optional[History] = None) -> None:
+        self._history = ListHistory() if history is None else history
         self._editor = editor
 
+    def close(self) -> None:
+        self._history.close()
+
+    def __enter__(self) -> "Application":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
     def save(self) -> None:
         print("Changes saved!")
-        self._history.append(self._editor.create_snapshot())
+        self._history.push(self._editor.create_snapshot())
 
     def undo(self) -> None:
         if not len(self._history):
@@ -86,10 +428,52 @@ class Application:
 
     def show_history(self) -> None:
         print("History:")
-        for idx, snapshot in reversed(list(enumerate(self._history))):
+        for idx, snapshot in reversed(list(enumerate(self._history.entries()))):
             print(f"{idx + 1}::{snapshot.get_name()}::{snapshot.get_datetime()}")
 
 
+def benchmark(document_size: int = 1_000_000, saves: int = 1000, keyframe_interval: int = 100) -> None:
+    """Small edits of a big document, call with 10_000_000 and 10_000 for the 10MB case."""
+    text = generate_random_string(document_size)
+    tracemalloc.start()
+    history = DeltaHistory(keyframe_interval=keyframe_interval)
+    for _ in range(saves):
+        position = random.randrange(len(text))
+        text = text[:position] + generate_random_string(8) + text[position + 8:]
+        history.push(Snapshot(State(text)))
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Delta history of {saves} saves: {memory / 1024 / 1024:.1f}MB, "
+          f"full snapshots would take {saves * sys.getsizeof(text) / 1024 / 1024:.1f}MB")
+
+    started = time.perf_counter()
+    while len(history):
+        history.pop()
+    elapsed = time.perf_counter() - started
+    print(f"Restore latency: {elapsed / saves * 1000:.3f}ms per undo")
+
+
+def spill_benchmark(document_size: int = 100_000, saves: int = 1000, memory_entries: int = 16) -> None:
+    text = generate_random_string(document_size)
+    tracemalloc.start()
+    with SpillingHistory(memory_entries=memory_entries) as history:
+        for _ in range(saves):
+            position = random.randrange(len(text))
+            text = text[:position] + generate_random_string(8) + text[position + 8:]
+            history.push(Snapshot(State(text)))
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Spilling history of {saves} saves: {memory / 1024 / 1024:.1f}MB in memory, "
+              f"{history.disk_size / 1024 / 1024:.1f}MB on disk")
+
+        for label, count in (("in memory", memory_entries), ("spilled", saves - memory_entries)):
+            started = time.perf_counter()
+            for _ in range(count):
+                history.pop()
+            elapsed = time.perf_counter() - started
+            print(f"Undo {label}: {elapsed / count * 1000:.3f}ms per entry")
+
+
 if __name__ == "__main__":
     editor = Editor()
     app = Application(editor)
@@ -107,3 +491,25 @@ if __name__ == "__main__":
     app.undo()
 
     app.show_history()
+
+    delta_app = Application(editor, DeltaHistory(keyframe_interval=3, max_entries=4))
+    for _ in range(6):
+        editor.make_change()
+        delta_app.save()
+    delta_app.show_history()
+    delta_app.undo()
+    delta_app.undo()
+    delta_app.show_history()
+
+    benchmark()
+
+    # the segment file is removed when the application is closed
+    with Application(editor, SpillingHistory(memory_entries=2, codec="lzma")) as spilling_app:
+        for _ in range(4):
+            editor.make_change()
+            spilling_app.save()
+        spilling_app.show_history()
+        for _ in range(3):
+            spilling_app.undo()
+        spilling_app.show_history()
+    spill_benchmark()
@@ -1,9 +1,17 @@
 """
 Observer defines a subscription mechanism to notify multiple objects about any events that happen to the object they’re observing.
 """
-from typing import Set
+import asyncio
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 Data = dict
+ErrorHandler = Callable[["Subscriber", Exception], None]
 
 
 class Subscriber:
@@ -12,19 +20,436 @@ class Subscriber:
         ...
 
 
+def print_error(subscriber: Subscriber, exc: Exception) -> None:
+    print(f"{subscriber.__class__.__name__} failed to handle the event: {exc!r}")
+
+
+def deliver(subscriber: Subscriber, data: Data, on_error: ErrorHandler) -> None:
+    # a failing subscriber must not stop the deliveries to the others
+    try:
+        subscriber.update(data)
+    except Exception as exc:
+        on_error(subscriber, exc)
+
+
+class Dispatcher(ABC):
+
+    def __init__(self, on_error: ErrorHandler = print_error) -> None:
+        self.on_error = on_error
+
+    @abstractmethod
+    def dispatch(self, subscribers: List[Subscriber], data: Data) -> None:
+        ...
+
+    def remove(self, subscriber: Subscriber) -> None:
+        ...
+
+    def close(self) -> None:
+        """Wait until every dispatched event is delivered."""
+
+
+class InlineDispatcher(Dispatcher):
+    """Calls subscribers one by one on the publisher's thread."""
+
+    def dispatch(self, subscribers: List[Subscriber], data: Data) -> None:
+        for sub in subscribers:
+            deliver(sub, data, self.on_error)
+
+
+class ThreadPoolDispatcher(Dispatcher):
+    """Fans every delivery out to a thread pool, events of one subscriber may be handled out of order."""
+
+    def __init__(
+        self, max_workers: Optional[int] = None, chunk_size: int = 16, on_error: ErrorHandler = print_error
+    ) -> None:
+        super().__init__(on_error)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # one task per chunk of subscribers, a task per delivery costs more than a fast update
+        self._chunk_size = chunk_size
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def dispatch(self, subscribers: List[Subscriber], data: Data) -> None:
+        futures = [
+            self._executor.submit(self._deliver_chunk, subscribers[idx:idx + self._chunk_size], data)
+            for idx in range(0, len(subscribers), self._chunk_size)
+        ]
+        with self._lock:
+            self._pending.update(futures)
+            self._pending = {future for future in self._pending if not future.done()}
+
+    def _deliver_chunk(self, subscribers: List[Subscriber], data: Data) -> None:
+        for sub in subscribers:
+            deliver(sub, data, self.on_error)
+
+    def close(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        wait(pending)
+        self._executor.shutdown()
+
+
+# set while a pool thread drains a mailbox, waiting for the drain from inside of it would never end
+_draining = threading.local()
+
+
+class Mailbox:
+    """
+    Bounded queue of events for one subscriber. It's drained by one pool thread at a time, so the
+    subscriber gets its events in order. The subscriber is referenced weakly, the mailbox must not
+    keep alive a subscriber its publisher only holds weakly.
+    """
+
+    def __init__(
+        self, subscriber: Subscriber, maxsize: int, policy: str, on_error: ErrorHandler, executor: Executor
+    ) -> None:
+        self._subscriber = weakref.ref(subscriber)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_error = on_error
+        self.dropped = 0
+        self._executor = executor
+        self._events: Deque[Data] = deque()
+        self._condition = threading.Condition()
+        self._scheduled = False
+        self._closed = False
+
+    def put(self, data: Data) -> None:
+        with self._condition:
+            if len(self._events) >= self.maxsize:
+                if self.policy == QueueDispatcher.DROP_OLDEST:
+                    self._events.popleft()
+                    self.dropped += 1
+                else:
+                    self._condition.wait_for(lambda: len(self._events) < self.maxsize or self._closed)
+            if self._closed:
+                return
+            self._events.append(data)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._executor.submit(self._drain)
+
+    def close(self, wait: bool = True) -> None:
+        """Stop accepting events, with ``wait`` also wait until the queued ones are delivered."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            if wait and getattr(_draining, "mailbox", None) is not self:
+                self._condition.wait_for(lambda: not self._scheduled)
+
+    def _drain(self) -> None:
+        _draining.mailbox = self
+        try:
+            self._drain_events()
+        finally:
+            _draining.mailbox = None
+
+    def _drain_events(self) -> None:
+        while True:
+            with self._condition:
+                # take everything at once, fewer lock round-trips than event by event
+                events = list(self._events)
+                self._events.clear()
+                if not events:
+                    self._scheduled = False
+                self._condition.notify_all()
+            if not events:
+                return
+            subscriber = self._subscriber()
+            if subscriber is None:
+                # garbage collected, nobody is left to handle the events
+                continue
+            for data in events:
+                deliver(subscriber, data, self.on_error)
+            del subscriber
+
+
+class QueueDispatcher(Dispatcher):
+    """Every subscriber gets a bounded mailbox, so a slow one only delays its own events."""
+    DROP_OLDEST = "drop_oldest"
+    BLOCK = "block"
+
+    def __init__(
+        self,
+        maxsize: int = 1000,
+        policy: str = DROP_OLDEST,
+        max_workers: Optional[int] = None,
+        on_error: ErrorHandler = print_error,
+    ) -> None:
+        if policy not in (self.DROP_OLDEST, self.BLOCK):
+            raise ValueError(f"Unknown overflow policy {policy!r}")
+        super().__init__(on_error)
+        self.maxsize = maxsize
+        self.policy = policy
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # keyed weakly, a garbage collected subscriber takes its mailbox with it
+        self._mailboxes: "weakref.WeakKeyDictionary[Subscriber, Mailbox]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def dispatch(self, subscribers: List[Subscriber], data: Data) -> None:
+        for sub in subscribers:
+            self._mailbox(sub).put(data)
+
+    def _mailbox(self, subscriber: Subscriber) -> Mailbox:
+        mailbox = self._mailboxes.get(subscriber)
+        if mailbox is None:
+            with self._lock:
+                mailbox = self._mailboxes.get(subscriber)
+                if mailbox is None:
+                    mailbox = Mailbox(subscriber, self.maxsize, self.policy, self.on_error, self._executor)
+                    self._mailboxes[subscriber] = mailbox
+        return mailbox
+
+    def dropped(self) -> int:
+        with self._lock:
+            mailboxes = list(self._mailboxes.values())
+        return sum(mailbox.dropped for mailbox in mailboxes)
+
+    def remove(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            mailbox = self._mailboxes.pop(subscriber, None)
+        if mailbox is not None:
+            # don't wait, the subscriber could be removing itself from its own update()
+            mailbox.close(wait=False)
+
+    def close(self) -> None:
+        with self._lock:
+            mailboxes, self._mailboxes = list(self._mailboxes.values()), weakref.WeakKeyDictionary()
+        for mailbox in mailboxes:
+            mailbox.close()
+        # a pool thread can't wait for the pool, the remaining events are still delivered
+        self._executor.shutdown(wait=getattr(_draining, "mailbox", None) is None)
+
+
+class StrongRef:
+    """Same interface as weakref.ref, but keeps the subscriber alive."""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any) -> None:
+        self.obj = obj
+
+    def __call__(self) -> Any:
+        return self.obj
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, StrongRef) and other.obj is self.obj
+
+    def __hash__(self) -> int:
+        return hash(self.obj)
+
+
+SubscriberRef = Union[StrongRef, "weakref.ref[Subscriber]"]
+
+
+class TopicTrie:
+    """
+    Subscriptions by dot-separated topics. "orders.*" gets every topic under "orders." and "*" gets
+    every topic at all, so matching costs the number of topic segments plus interested subscribers.
+    """
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "TopicTrie"] = {}
+        # immutable snapshots, replaced on change, so match() never sees a half-updated collection
+        self.exact: Tuple[SubscriberRef, ...] = ()
+        self.wildcard: Tuple[SubscriberRef, ...] = ()
+
+    def _node(self, topic: str, create: bool) -> Tuple[Optional["TopicTrie"], bool]:
+        *segments, last = topic.split(".")
+        if last != "*":
+            segments.append(last)
+        node = self
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                if not create:
+                    return None, False
+                child = node.children[segment] = TopicTrie()
+            node = child
+        return node, last == "*"
+
+    def add(self, topic: str, ref: SubscriberRef) -> None:
+        node, wildcard = self._node(topic, create=True)
+        if wildcard:
+            if ref not in node.wildcard:
+                node.wildcard += (ref,)
+        elif ref not in node.exact:
+            node.exact += (ref,)
+
+    def discard(self, topic: str, ref: SubscriberRef) -> None:
+        node, wildcard = self._node(topic, create=False)
+        if node is None:
+            return
+        if wildcard:
+            node.wildcard = tuple(item for item in node.wildcard if item != ref)
+        else:
+            node.exact = tuple(item for item in node.exact if item != ref)
+
+    def match(self, topic: str) -> Iterator[SubscriberRef]:
+        node = self
+        for segment in topic.split("."):
+            yield from node.wildcard
+            node = node.children.get(segment)
+            if node is None:
+                return
+        yield from node.exact
+
+
 class Publisher:
-    subscribers: Set[Subscriber] = set()
+    """
+    Subscriptions are copy-on-write: every change builds new collections under a lock and swaps them
+    in, so notifications read a consistent snapshot without any locking.
+    """
+
+    def __init__(self, dispatcher: Optional[Dispatcher] = None, weak: bool = False) -> None:
+        self.dispatcher = InlineDispatcher() if dispatcher is None else dispatcher
+        # weakly referenced subscribers are unsubscribed once they are garbage collected, dispatchers
+        # must not keep them alive either (QueueDispatcher keys its mailboxes weakly)
+        self._weak = weak
+        # reentrant, the garbage collector could run the weakref callback while the lock is held
+        self._lock = threading.RLock()
+        # subscriber -> its topics, None means every event
+        self._subscriptions: Dict[SubscriberRef, Optional[Tuple[str, ...]]] = {}
+        self._everything: Tuple[SubscriberRef, ...] = ()
+        self._topics = TopicTrie()
+
+    @property
+    def subscribers(self) -> List[Subscriber]:
+        return self._resolve(self._subscriptions)
 
-    def add_subscriber(self, subscriber: Subscriber) -> None:
-        self.subscribers.add(subscriber)
+    def _ref(self, subscriber: Subscriber) -> SubscriberRef:
+        if self._weak:
+            return weakref.ref(subscriber, self._forget)
+        return StrongRef(subscriber)
+
+    def add_subscriber(self, subscriber: Subscriber, topics: Optional[Iterable[str]] = None) -> None:
+        ref = self._ref(subscriber)
+        topics = None if topics is None else tuple(topics)
+        with self._lock:
+            if ref in self._subscriptions:
+                self._forget(ref)
+            self._subscriptions = {**self._subscriptions, ref: topics}
+            if topics is None:
+                self._everything += (ref,)
+            else:
+                for topic in topics:
+                    self._topics.add(topic, ref)
 
     def remove_subscriber(self, subscriber: Subscriber) -> None:
-        self.subscribers.remove(subscriber)
+        ref = self._ref(subscriber)
+        with self._lock:
+            if ref not in self._subscriptions:
+                raise KeyError(subscriber)
+            self._forget(ref)
+        self.dispatcher.remove(subscriber)
+
+    def _forget(self, ref: SubscriberRef) -> None:
+        with self._lock:
+            subscriptions = dict(self._subscriptions)
+            topics = subscriptions.pop(ref, None)
+            self._subscriptions = subscriptions
+            self._everything = tuple(item for item in self._everything if item != ref)
+            for topic in topics or ():
+                self._topics.discard(topic, ref)
 
-    def notify_all(self, data: Data) -> None:
+    @staticmethod
+    def _resolve(refs: Iterable[SubscriberRef]) -> List[Subscriber]:
+        return [sub for ref in refs if (sub := ref()) is not None]
+
+    def notify_all(self, data: Data, topic: Optional[str] = None) -> None:
         print("New event triggered! Notify all!")
-        for sub in self.subscribers:
-            sub.update(data)
+        self.publish(data, topic)
+
+    def publish(self, data: Data, topic: Optional[str] = None) -> None:
+        if topic is None:
+            # events without a topic go only to the subscribers of everything
+            subscribers = self._resolve(self._everything)
+        else:
+            # a subscriber could match several of its topics, it still gets the event once
+            refs = dict.fromkeys(self._everything)
+            refs.update(dict.fromkeys(self._topics.match(topic)))
+            subscribers = self._resolve(refs)
+        self.dispatcher.dispatch(subscribers, data)
+
+
+class LockingPublisher(Publisher):
+    """Takes the lock for every notification, the baseline for copy-on-write snapshots."""
+
+    def publish(self, data: Data, topic: Optional[str] = None) -> None:
+        with self._lock:
+            super().publish(data, topic)
+
+
+class AsyncSubscriber:
+
+    async def update(self, data: Data) -> None:
+        ...
+
+    async def update_batch(self, events: List[Data]) -> None:
+        for data in events:
+            await self.update(data)
+
+
+class AsyncPublisher:
+    """
+    Notifies subscribers concurrently, at most ``concurrency`` at a time. With ``batch_size`` or
+    ``batch_window`` set, events are buffered and each subscriber gets them in one update_batch call.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 100,
+        batch_size: Optional[int] = None,
+        batch_window: Optional[float] = None,
+        on_error: ErrorHandler = print_error,
+    ) -> None:
+        self.subscribers: List[AsyncSubscriber] = []
+        self.on_error = on_error
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._batching = batch_size is not None or batch_window is not None
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+        self._buffer: List[Data] = []
+        self._timer: Optional[asyncio.Task] = None
+
+    def add_subscriber(self, subscriber: AsyncSubscriber) -> None:
+        self.subscribers.append(subscriber)
+
+    def remove_subscriber(self, subscriber: AsyncSubscriber) -> None:
+        self.subscribers.remove(subscriber)
+
+    async def notify_all(self, data: Data) -> None:
+        if not self._batching:
+            await self._fan_out(lambda sub: sub.update(data))
+            return
+
+        self._buffer.append(data)
+        if self._batch_size is not None and len(self._buffer) >= self._batch_size:
+            await self.flush()
+        elif self._batch_window is not None and self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        events, self._buffer = self._buffer, []
+        if events:
+            await self._fan_out(lambda sub: sub.update_batch(events))
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._batch_window)
+        await self.flush()
+
+    async def _fan_out(self, make_call: Callable[[AsyncSubscriber], Awaitable[None]]) -> None:
+        async def call(sub: AsyncSubscriber) -> None:
+            async with self._semaphore:
+                try:
+                    await make_call(sub)
+                except Exception as exc:
+                    self.on_error(sub, exc)
+
+        await asyncio.gather(*(call(sub) for sub in self.subscribers))
 
 
 class ConcreteSubscriberA(Subscriber):
@@ -37,6 +462,132 @@ class ConcreteSubscriberB(Subscriber):
         print("Update in concreate component B")
 
 
+class CountingSubscriber(Subscriber):
+
+    def __init__(self, delay: float = 0) -> None:
+        self.delay = delay
+        self.received = 0
+
+    def update(self, data: Data) -> None:
+        if self.delay:
+            time.sleep(self.delay)
+        self.received += 1
+
+
+class LockedCountingSubscriber(CountingSubscriber):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def update(self, data: Data) -> None:
+        with self._lock:
+            self.received += 1
+
+
+class FailingSubscriber(Subscriber):
+
+    def update(self, data: Data) -> None:
+        raise RuntimeError("boom")
+
+
+def benchmark(subscribers: int = 1000, slow: int = 10, events: int = 50) -> None:
+    for name, make_dispatcher in (
+        ("inline", InlineDispatcher),
+        ("thread pool", lambda: ThreadPoolDispatcher(max_workers=32)),
+        ("queues", lambda: QueueDispatcher(maxsize=10, policy=QueueDispatcher.DROP_OLDEST, max_workers=32)),
+    ):
+        publisher = Publisher(make_dispatcher())
+        for idx in range(subscribers):
+            publisher.add_subscriber(CountingSubscriber(delay=0.001 if idx < slow else 0))
+        started = time.perf_counter()
+        for _ in range(events):
+            publisher.dispatcher.dispatch(publisher.subscribers, {"foo": "bar"})
+        published = time.perf_counter() - started
+        publisher.dispatcher.close()
+        delivered = time.perf_counter() - started
+        print(f"{name}: publisher blocked {published * 1000:.0f}ms, "
+              f"{events * subscribers / delivered:,.0f} deliveries/s")
+
+
+class AsyncCountingSubscriber(AsyncSubscriber):
+
+    def __init__(self) -> None:
+        self.received = 0
+
+    async def update(self, data: Data) -> None:
+        self.received += 1
+
+    async def update_batch(self, events: List[Data]) -> None:
+        self.received += len(events)
+
+
+async def async_benchmark(subscribers: int = 100, events: int = 2000) -> None:
+    for name, publisher in (
+        ("async", AsyncPublisher()),
+        ("async batched", AsyncPublisher(batch_size=500, batch_window=0.01)),
+    ):
+        subs = [AsyncCountingSubscriber() for _ in range(subscribers)]
+        for sub in subs:
+            publisher.add_subscriber(sub)
+        started = time.perf_counter()
+        for _ in range(events):
+            await publisher.notify_all({"foo": "bar"})
+        await publisher.flush()
+        elapsed = time.perf_counter() - started
+        assert all(sub.received == events for sub in subs)
+        print(f"{name}: {events / elapsed:,.0f} events/s to {subscribers} subscribers")
+
+
+def stress_test(publisher_class: type = Publisher, notifiers: int = 16, duration: float = 1.0) -> int:
+    """Notify from many threads while subscribers keep coming and going, returns events published."""
+    publisher = publisher_class()
+    stable = LockedCountingSubscriber()
+    publisher.add_subscriber(stable, topics=["orders.*"])
+    everything = LockedCountingSubscriber()
+    publisher.add_subscriber(everything)
+    stop = threading.Event()
+    # every thread starts hammering only after all of them exist, otherwise starting the rest starves
+    ready = threading.Barrier(notifiers + 2)
+    errors: List[BaseException] = []
+    published = [0] * notifiers
+
+    def notify(idx: int) -> None:
+        ready.wait()
+        try:
+            while not stop.is_set():
+                publisher.publish({"foo": "bar"}, topic="orders.created")
+                publisher.publish({"foo": "bar"})
+                published[idx] += 2
+        except BaseException as exc:
+            errors.append(exc)
+
+    def churn() -> None:
+        ready.wait()
+        while not stop.is_set():
+            subs = [CountingSubscriber() for _ in range(10)]
+            for idx, sub in enumerate(subs):
+                publisher.add_subscriber(sub, topics=["orders.*"] if idx % 2 else None)
+            for sub in subs:
+                publisher.remove_subscriber(sub)
+
+    threads = [threading.Thread(target=notify, args=(idx,)) for idx in range(notifiers)]
+    threads.append(threading.Thread(target=churn))
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors
+    # half of the events have a topic, the other half only reaches the subscribers of everything
+    assert stable.received == sum(published) // 2
+    assert everything.received == sum(published)
+    return sum(published)
+
+
 if __name__ == "__main__":
     event = {"foo": "bar"}
     subA = ConcreteSubscriberA()
@@ -50,3 +601,23 @@ if __name__ == "__main__":
     publisher.notify_all(event)
     publisher.remove_subscriber(subB)
     publisher.notify_all(event)
+
+    publisher = Publisher(weak=True)
+    publisher.add_subscriber(subA, topics=["orders.*"])
+    publisher.add_subscriber(ConcreteSubscriberB(), topics=["orders.created"])
+    # the second subscriber is gone already, only A gets the event
+    publisher.notify_all(event, topic="orders.created")
+    publisher.notify_all(event, topic="users.created")
+
+    publisher = Publisher(QueueDispatcher(maxsize=100, policy=QueueDispatcher.BLOCK))
+    publisher.add_subscriber(FailingSubscriber())
+    publisher.add_subscriber(subA)
+    publisher.notify_all(event)
+    publisher.dispatcher.close()
+
+    benchmark()
+    asyncio.run(async_benchmark())
+
+    for publisher_class in (Publisher, LockingPublisher):
+        events = stress_test(publisher_class)
+        print(f"{publisher_class.__name__}: {events:,} events/s from 16 threads with subscribe churn")
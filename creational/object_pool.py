@@ -4,29 +4,453 @@ and destroying them on demand. A client of the pool will request an object from
  operations on the returned object. When the client has finished, it returns the object to the pool
  rather than destroying it; this can be done manually or automatically.
 """
+import asyncio
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional
 
+MetricsSink = Callable[[str, float], None]
 
-class Connection:
+
+class PoolTimeoutError(Exception):
     pass
 
 
+@dataclass(frozen=True)
+class Percentiles:
+    count: int
+    p50: float
+    p95: float
+    p99: float
+
+
+class Histogram:
+    """Exponential buckets from ``lowest`` seconds up, memory doesn't depend on the number of samples."""
+
+    def __init__(self, lowest: float = 1e-6, buckets: int = 40) -> None:
+        self._bounds = [lowest * 2 ** idx for idx in range(buckets)]
+        self._counts = [0] * (buckets + 1)
+        self._count = 0
+
+    def record(self, value: float) -> None:
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._count += 1
+
+    def percentile(self, quantile: float) -> float:
+        """Upper bound of the bucket holding the requested quantile."""
+        if not self._count:
+            return 0.0
+        rank = quantile * self._count
+        seen = 0
+        for idx, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        return self._bounds[idx] if idx < len(self._bounds) else float("inf")
+
+    def snapshot(self) -> Percentiles:
+        return Percentiles(self._count, self.percentile(0.5), self.percentile(0.95), self.percentile(0.99))
+
+
+@dataclass(frozen=True)
+class Checkout:
+    acquired_at: float
+    stack: Optional[str]
+
+
+@dataclass(frozen=True)
+class Leak:
+    connection: "Connection"
+    held_for: float
+    stack: Optional[str]
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    size: int
+    available: int
+    acquired: int
+    peak_acquired: int
+    acquires: int
+    timeouts: int
+    created: int
+    evicted: int
+    wait_time: Percentiles
+    hold_time: Percentiles
+    leaks: List[Leak]
+
+    @property
+    def utilization(self) -> float:
+        return self.acquired / self.size if self.size else 0.0
+
+
+class Connection:
+
+    def __init__(self) -> None:
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+    def close(self) -> None:
+        ...
+
+
 class ConnectionPool:
 
-    def __init__(self, size: int = 10) -> None:
-        self._available_connections = set(Connection() for _ in range(size))
+    def __init__(
+        self,
+        max_size: int = 10,
+        min_size: Optional[int] = None,
+        max_idle_seconds: Optional[float] = None,
+        max_lifetime: Optional[float] = None,
+        validate: Optional[Callable[[Connection], bool]] = None,
+        reap_interval: float = 1.0,
+        leak_threshold: Optional[float] = None,
+        metrics_sink: Optional[MetricsSink] = None,
+        size: Optional[int] = None,
+    ) -> None:
+        # ``size`` is the old name of ``max_size``
+        if size is not None:
+            max_size = size
+        self._max_size = max_size
+        self._min_size = max_size if min_size is None else min_size
+        self._max_idle_seconds = max_idle_seconds
+        self._max_lifetime = max_lifetime
+        self._validate = validate
+        # most recently released connections are on the right, so idle ones gather on the left
+        self._available_connections: Deque[Connection] = deque(
+            Connection() for _ in range(self._min_size)
+        )
         self._acquired_connections = set()
+        # created connections, including the ones being created right now
+        self._size = self._min_size
+        self._lock = threading.Lock()
+        # every waiting thread has its own condition, so release wakes up exactly the oldest one
+        self._waiters: Deque[threading.Condition] = deque()
+        # metrics, guarded by the same lock as the pool itself
+        self._leak_threshold = leak_threshold
+        self._metrics_sink = metrics_sink
+        self._checkouts: Dict[Connection, Checkout] = {}
+        self._wait_times = Histogram()
+        self._hold_times = Histogram()
+        self._peak_acquired = 0
+        self._acquires = 0
+        self._timeouts = 0
+        self._created = self._min_size
+        self._evicted = 0
+        self._closed = threading.Event()
+        self._reaper: Optional[threading.Thread] = None
+        if max_idle_seconds is not None or max_lifetime is not None:
+            self._reaper = threading.Thread(target=self._reap, args=(reap_interval,), daemon=True)
+            self._reaper.start()
+
+    def acquire(self, timeout: Optional[float] = None) -> Connection:
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        try:
+            while True:
+                connection = self._checkout(deadline, timeout)
+                if connection is None:
+                    connection = self._create()
+                    break
+                if self._is_usable(connection):
+                    break
+                self._discard(connection)
+        except PoolTimeoutError:
+            with self._lock:
+                self._timeouts += 1
+            self._emit("acquire_timeout", 1)
+            raise
+
+        now = time.monotonic()
+        # capturing the stack is expensive, so it's done only when leak detection is on
+        stack = "".join(traceback.format_stack()[:-1]) if self._leak_threshold is not None else None
+        with self._lock:
+            self._checkouts[connection] = Checkout(now, stack)
+            self._acquires += 1
+            self._wait_times.record(now - started)
+            self._peak_acquired = max(self._peak_acquired, len(self._acquired_connections))
+        self._emit("acquire_wait", now - started)
+        return connection
+
+    def release(self, connection: Connection) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._acquired_connections.remove(connection)
+            held_for = now - self._checkouts.pop(connection).acquired_at
+            self._hold_times.record(held_for)
+            expired = self._is_expired(connection, now)
+            if expired:
+                self._size -= 1
+                self._evicted += 1
+            else:
+                connection.last_used_at = now
+                self._available_connections.append(connection)
+            self._wake_next()
+        self._emit("hold", held_for)
+        if expired:
+            connection.close()
+            self._emit("evicted", 1)
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Connection]:
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def get_info(self) -> str:
+        with self._lock:
+            return f"{len(self._available_connections)}/{len(self._acquired_connections)}"
+
+    def stats(self) -> PoolStats:
+        now = time.monotonic()
+        with self._lock:
+            leaks = []
+            if self._leak_threshold is not None:
+                for connection, checkout in self._checkouts.items():
+                    held_for = now - checkout.acquired_at
+                    if held_for > self._leak_threshold:
+                        leaks.append(Leak(connection, held_for, checkout.stack))
+            return PoolStats(
+                size=self._size,
+                available=len(self._available_connections),
+                acquired=len(self._acquired_connections),
+                peak_acquired=self._peak_acquired,
+                acquires=self._acquires,
+                timeouts=self._timeouts,
+                created=self._created,
+                evicted=self._evicted,
+                wait_time=self._wait_times.snapshot(),
+                hold_time=self._hold_times.snapshot(),
+                leaks=leaks,
+            )
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._reaper is not None:
+            self._reaper.join()
+        with self._lock:
+            idle, self._available_connections = self._available_connections, deque()
+            self._size -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def _checkout(self, deadline: Optional[float], timeout: Optional[float]) -> Optional[Connection]:
+        """Take an idle connection, or return None once the caller is allowed to create a new one."""
+        with self._lock:
+            if not self._waiters and self._has_capacity():
+                return self._take()
+
+            waiter = threading.Condition(self._lock)
+            self._waiters.append(waiter)
+            try:
+                while self._waiters[0] is not waiter or not self._has_capacity():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeoutError(f"No connection available after {timeout} seconds")
+                    waiter.wait(remaining)
+                return self._take()
+            finally:
+                self._waiters.remove(waiter)
+                self._wake_next()
+
+    def _has_capacity(self) -> bool:
+        return bool(self._available_connections) or self._size < self._max_size
 
-    def acquire(self) -> Connection:
+    def _take(self) -> Optional[Connection]:
+        if not self._available_connections:
+            # reserve the slot, the connection itself is created outside the lock
+            self._size += 1
+            return None
         connection = self._available_connections.pop()
         self._acquired_connections.add(connection)
         return connection
 
+    def _create(self) -> Connection:
+        try:
+            connection = Connection()
+        except BaseException:
+            with self._lock:
+                self._size -= 1
+                self._wake_next()
+            raise
+        with self._lock:
+            self._acquired_connections.add(connection)
+            self._created += 1
+        self._emit("created", 1)
+        return connection
+
+    def _discard(self, connection: Connection) -> None:
+        with self._lock:
+            self._acquired_connections.remove(connection)
+            self._size -= 1
+            self._evicted += 1
+            self._wake_next()
+        connection.close()
+        self._emit("evicted", 1)
+
+    def _is_expired(self, connection: Connection, now: float) -> bool:
+        return self._max_lifetime is not None and now - connection.created_at > self._max_lifetime
+
+    def _is_usable(self, connection: Connection) -> bool:
+        if self._is_expired(connection, time.monotonic()):
+            return False
+        if self._validate is None:
+            return True
+        try:
+            return self._validate(connection)
+        except Exception:
+            # a failing check means a broken connection, the caller discards it and tries another one
+            return False
+
+    def _reap(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            self._evict()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            kept: Deque[Connection] = deque()
+            for connection in self._available_connections:
+                idle = (self._max_idle_seconds is not None
+                        and now - connection.last_used_at > self._max_idle_seconds)
+                if self._is_expired(connection, now) or (idle and self._size > self._min_size):
+                    self._size -= 1
+                    evicted.append(connection)
+                else:
+                    kept.append(connection)
+            self._available_connections = kept
+            # recycled connections are replaced to keep the pool warm
+            missing = max(self._min_size - self._size, 0)
+            self._size += missing
+            self._evicted += len(evicted)
+
+        for connection in evicted:
+            connection.close()
+            self._emit("evicted", 1)
+        for _ in range(missing):
+            connection = Connection()
+            with self._lock:
+                self._available_connections.appendleft(connection)
+                self._created += 1
+                self._wake_next()
+            self._emit("created", 1)
+
+    def _wake_next(self) -> None:
+        if self._waiters and self._has_capacity():
+            self._waiters[0].notify()
+
+    def _emit(self, metric: str, value: float) -> None:
+        if self._metrics_sink is not None:
+            self._metrics_sink(metric, value)
+
+
+async def create_connection() -> Connection:
+    # could be any network handshake
+    return Connection()
+
+
+class AsyncConnectionPool:
+
+    def __init__(
+        self,
+        max_size: int = 10,
+        connection_factory: Callable[[], Awaitable[Connection]] = create_connection,
+    ) -> None:
+        self._connection_factory = connection_factory
+        # ``None`` marks a free slot where a connection is not created yet. LIFO order hands out
+        # warm connections first and creates new ones only when all of them are busy.
+        self._slots: asyncio.LifoQueue[Optional[Connection]] = asyncio.LifoQueue()
+        for _ in range(max_size):
+            self._slots.put_nowait(None)
+        self._acquired_connections = set()
+        self._created = 0
+
+    async def acquire(self, timeout: Optional[float] = None) -> Connection:
+        try:
+            async with asyncio.timeout(timeout):
+                connection = await self._slots.get()
+        except TimeoutError:
+            raise PoolTimeoutError(f"No connection available after {timeout} seconds") from None
+
+        if connection is None:
+            try:
+                connection = await self._connection_factory()
+            except BaseException:
+                # give the slot back, otherwise failed or cancelled creation shrinks the pool
+                self._slots.put_nowait(None)
+                raise
+            self._created += 1
+        self._acquired_connections.add(connection)
+        return connection
+
     def release(self, connection: Connection) -> None:
+        # no awaits here, so release can't be interrupted by cancellation
         self._acquired_connections.remove(connection)
-        self._available_connections.add(connection)
+        self._slots.put_nowait(connection)
+
+    @asynccontextmanager
+    async def connection(self, timeout: Optional[float] = None) -> AsyncIterator[Connection]:
+        connection = await self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
 
     def get_info(self) -> str:
-        return f"{len(self._available_connections)}/{len(self._acquired_connections)}"
+        acquired = len(self._acquired_connections)
+        return f"{self._created - acquired}/{acquired}"
+
+
+def benchmark(threads: int = 64, size: int = 8, iterations: int = 200) -> None:
+    pool = ConnectionPool(size)
+    waits: List[float] = []
+    waits_lock = threading.Lock()
+
+    def worker() -> None:
+        local_waits = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            with pool.connection():
+                local_waits.append(time.perf_counter() - started)
+                time.sleep(0.0001)
+        with waits_lock:
+            waits.extend(local_waits)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    waits.sort()
+    p50 = waits[len(waits) // 2] * 1000
+    p99 = waits[int(len(waits) * 0.99)] * 1000
+    print(f"{threads} threads / {size} connections: {len(waits) / elapsed:.0f} acquires/s, "
+          f"wait p50={p50:.2f}ms p99={p99:.2f}ms, pool {pool.get_info()}")
+
+
+async def async_benchmark(coroutines: int = 5000, size: int = 8) -> None:
+    pool = AsyncConnectionPool(max_size=size)
+
+    async def handle_request() -> None:
+        async with pool.connection():
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handle_request() for _ in range(coroutines)))
+    elapsed = time.perf_counter() - started
+    print(f"{coroutines} coroutines / {size} connections: {coroutines / elapsed:.0f} acquires/s, "
+          f"pool {pool.get_info()}")
 
 
 if __name__ == "__main__":
@@ -35,3 +459,33 @@ if __name__ == "__main__":
     print(pool.get_info())
     pool.release(conn)
     print(pool.get_info())
+
+    with pool.connection() as conn:
+        print(pool.get_info())
+    print(pool.get_info())
+
+    elastic_pool = ConnectionPool(max_size=10, min_size=2, max_idle_seconds=0.1, reap_interval=0.05)
+    connections = [elastic_pool.acquire() for _ in range(10)]
+    for conn in connections:
+        elastic_pool.release(conn)
+    print(f"Peak load: {elastic_pool.get_info()}")
+    time.sleep(0.3)
+    print(f"After idle eviction: {elastic_pool.get_info()}")
+    elastic_pool.close()
+
+    metrics: Counter = Counter()
+    observed_pool = ConnectionPool(
+        max_size=4, leak_threshold=0.05, metrics_sink=lambda metric, value: metrics.update({metric: value})
+    )
+    leaked = observed_pool.acquire()
+    with observed_pool.connection():
+        pass
+    time.sleep(0.1)
+    stats = observed_pool.stats()
+    print(f"Wait {stats.wait_time}, hold {stats.hold_time}, utilization {stats.utilization:.0%}")
+    print(f"Metrics {metrics}")
+    for leak in stats.leaks:
+        print(f"Connection held for {leak.held_for:.2f}s, acquired at:\n{leak.stack}")
+
+    benchmark()
+    asyncio.run(async_benchmark())
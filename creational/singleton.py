@@ -1,22 +1,179 @@
 """
 Ensure a class only has one instance, and provide a global point of access to it.
 """
+import asyncio
+import importlib
+import os
+import sys
+import threading
+import timeit
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Dict, Iterable, Optional
 
 
-class Singleton:
-    instance = None
+class Scope(Enum):
+    # one instance per process, a forked child builds its own
+    PROCESS = "process"
+    # one instance per thread
+    THREAD = "thread"
 
-    def __new__(cls, *args, **kwargs):
-        if cls.instance is None:
-            cls.instance = super().__new__(cls, *args, **kwargs)
-        return cls.instance
+
+class SingletonMeta(type):
+    _classes: "weakref.WeakSet[SingletonMeta]" = weakref.WeakSet()
+
+    def __new__(mcs, name: str, bases: tuple, namespace: dict, scope: Optional[Scope] = None):
+        return super().__new__(mcs, name, bases, namespace)
+
+    def __init__(cls, name: str, bases: tuple, namespace: dict, scope: Optional[Scope] = None) -> None:
+        super().__init__(name, bases, namespace)
+        cls._scope = scope or getattr(cls, "_scope", Scope.PROCESS)
+        # plain bool, enum member lookups are too slow for the hot path
+        cls._per_thread = cls._scope is Scope.THREAD
+        cls._reset()
+        SingletonMeta._classes.add(cls)
+
+    def __call__(cls, *args: Any, **kwargs: Any) -> Any:
+        # lock-free fast path once the instance exists
+        instance = cls._instance
+        if instance is not None:
+            return instance
+        if cls._per_thread:
+            instance = getattr(cls._local, "instance", None)
+            if instance is None:
+                instance = cls._local.instance = super().__call__(*args, **kwargs)
+            return instance
+
+        with cls._lock:
+            # double check, another thread could build it while we were waiting for the lock
+            instance = cls._instance
+            if instance is None:
+                instance = cls._instance = super().__call__(*args, **kwargs)
+        return instance
+
+    def _reset(cls) -> None:
+        cls._instance = None
+        cls._lock = threading.Lock()
+        cls._local = threading.local()
+
+    @classmethod
+    def _reset_all(mcs) -> None:
+        # instances (and locks possibly held by other threads) shouldn't leak into a forked child
+        for cls in list(mcs._classes):
+            cls._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=SingletonMeta._reset_all)
+
+
+class Singleton(metaclass=SingletonMeta):
+    ...
 
 
 class Example(Singleton):
     ...
 
 
+class ThreadExample(Singleton, scope=Scope.THREAD):
+    ...
+
+
+class LazyEntry:
+
+    def __init__(self, target: str) -> None:
+        self.target = target
+        self.instance: Any = None
+        self.lock = threading.Lock()
+
+    def load(self) -> Any:
+        # the module is imported only when the instance is requested for the first time
+        module_name, _, class_name = self.target.partition(":")
+        cls = getattr(importlib.import_module(module_name), class_name)
+        return cls()
+
+
+class SingletonRegistry:
+    """Maps names to "module:Class" targets, imports and builds each of them on first use."""
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, LazyEntry] = {}
+
+    def register(self, name: str, target: str) -> None:
+        if ":" not in target:
+            raise ValueError(f"Target should look like 'module:Class', got {target!r}")
+        self._entries[name] = LazyEntry(target)
+
+    def get(self, name: str) -> Any:
+        entry = self._entries[name]
+        instance = entry.instance
+        if instance is None:
+            with entry.lock:
+                instance = entry.instance
+                if instance is None:
+                    instance = entry.instance = entry.load()
+        return instance
+
+    async def aget(self, name: str) -> Any:
+        entry = self._entries[name]
+        if entry.instance is not None:
+            return entry.instance
+        # importing blocks, keep it away from the event loop
+        return await asyncio.to_thread(self.get, name)
+
+    def preload(self, names: Iterable[str], max_workers: Optional[int] = None) -> None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() re-raises the first loading error
+            list(executor.map(self.get, names))
+
+    def is_loaded(self, name: str) -> bool:
+        return self._entries[name].instance is not None
+
+
+def benchmark(number: int = 1_000_000) -> None:
+    instance = Example()
+
+    def get_instance() -> Example:
+        return instance
+
+    for name, stmt in (
+        ("Example()", "Example()"),
+        ("plain function call", "get_instance()"),
+        ("attribute lookup", "Example._instance"),
+    ):
+        elapsed = timeit.timeit(stmt, number=number, globals={**globals(), "get_instance": get_instance})
+        print(f"{name}: {elapsed / number * 1e9:.0f}ns")
+
+
 if __name__ == "__main__":
     obj1 = Example()
     obj2 = Example()
     assert obj1 is obj2
+
+    instances = set()
+    threads = [threading.Thread(target=lambda: instances.add(ThreadExample())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(instances) == 4
+    assert ThreadExample() is ThreadExample()
+
+    if hasattr(os, "fork"):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if Example() is not obj1 else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+
+    registry = SingletonRegistry()
+    registry.register("decoder", "json.decoder:JSONDecoder")
+    registry.register("random", "random:SystemRandom")
+    print(f"json imported before first use: {'json' in sys.modules}")
+    assert registry.get("decoder") is registry.get("decoder")
+    print(f"json imported after first use: {'json' in sys.modules}")
+    registry.preload(["random"])
+    assert asyncio.run(registry.aget("random")) is registry.get("random")
+
+    benchmark()
@@ -2,8 +2,17 @@
 Composite lets you compose objects into tree structures and then work with these structures as if
 they were individual objects.
 """
+import hashlib
+import operator
+import os
+import timeit
+import tracemalloc
 from abc import ABC, abstractmethod
-from typing import List
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import reduce
+from itertools import islice
+from typing import Any, Callable, Iterator, List, Optional, TextIO
 
 
 def space(level: int) -> str:
@@ -17,6 +26,7 @@ class Component(ABC):
 
     def __init__(self, name: str) -> None:
         self.name = name
+        self.parent: Optional["Folder"] = None
 
     def is_composite(self) -> bool:
         return False
@@ -32,13 +42,41 @@ class Component(ABC):
         pass
 
     def printify(self, tabs: int = 0) -> str:
-        return space(tabs) + self.name + "\n"
+        return "".join(self.iter_lines(tabs))
+
+    def iter_lines(self, tabs: int = 0) -> Iterator[str]:
+        yield space(tabs) + self.name + "\n"
+
+    def write_to(self, fileobj: TextIO) -> None:
+        fileobj.writelines(self.iter_lines())
+
+    def __getstate__(self) -> dict:
+        # a component shipped to another process shouldn't drag the whole tree with it
+        state = self.__dict__.copy()
+        state["parent"] = None
+        return state
+
+    def _propagate(self, delta: int) -> None:
+        # O(depth): only the ancestors keep sizes of their subtrees
+        node = self.parent
+        while node is not None:
+            node._size += delta
+            node = node.parent
 
 
 class File(Component):
 
+    def __init__(self, name: str, size: Optional[int] = None) -> None:
+        super().__init__(name)
+        self._size = len(name) if size is None else size
+
     def get_size(self) -> int:
-        return len(self.name)
+        return self._size
+
+    def resize(self, size: int) -> None:
+        delta = size - self._size
+        self._size = size
+        self._propagate(delta)
 
 
 class Folder(Component):
@@ -46,25 +84,389 @@ class Folder(Component):
     def __init__(self, name: str) -> None:
         super().__init__(name)
         self._children: List[Component] = []
+        # size of the whole subtree, the folder itself counts as 1
+        self._size = 1
 
     def is_composite(self) -> bool:
         return True
 
     def get_size(self) -> int:
-        sum_size = sum(children.get_size() for children in self._children)
-        return sum_size + 1
+        return self._size
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        for child in self._children:
+            child.parent = self
+
+    def iter_files(self) -> Iterator[File]:
+        stack = [iter(self._children)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+            elif isinstance(child, Folder):
+                stack.append(iter(child._children))
+            else:
+                yield child
+
+    def reduce(
+        self,
+        map_fn: Callable[[File], Any],
+        combine_fn: Callable[[Any, Any], Any],
+        initial: Any,
+        executor: Optional[Executor] = None,
+        granularity: int = 1024,
+    ) -> Any:
+        """
+        Map every file of the subtree and combine the results. With an executor files are sent to it
+        in batches of ``granularity``, so with a process pool both functions should be picklable.
+        """
+        files = self.iter_files()
+        if executor is None:
+            return map_reduce(map_fn, combine_fn, initial, files)
+
+        futures = []
+        while batch := list(islice(files, granularity)):
+            futures.append(executor.submit(map_reduce_batch, map_fn, combine_fn, batch))
+        # ``initial`` goes in once, it doesn't have to be an identity of combine_fn
+        return reduce(combine_fn, (future.result() for future in futures), initial)
+
+    def recompute_size(self) -> int:
+        """Size calculated from scratch, without the cached subtree sizes."""
+        # every folder counts as 1, explicit stack like iter_files
+        total = 0
+        stack: List[Folder] = [self]
+        while stack:
+            folder = stack.pop()
+            total += 1
+            for child in folder._children:
+                if isinstance(child, Folder):
+                    stack.append(child)
+                else:
+                    total += child.get_size()
+        return total
+
+    def check_consistency(self) -> bool:
+        """Verify that every cached subtree size and parent pointer matches the actual tree."""
+        stack: List[Folder] = [self]
+        while stack:
+            folder = stack.pop()
+            for child in folder._children:
+                if child.parent is not folder:
+                    return False
+                if isinstance(child, Folder):
+                    stack.append(child)
+            if folder._size != 1 + sum(child.get_size() for child in folder._children):
+                return False
+        return True
 
     def add(self, component: "Component") -> None:
+        node: Optional[Component] = self
+        while node is not None:
+            if node is component:
+                raise ValueError(f"Can't add {component.name} into itself or its own descendant")
+            node = node.parent
+        if component.parent is not None:
+            component.parent.remove(component)
         self._children.append(component)
+        component.parent = self
+        self._size += component.get_size()
+        self._propagate(component.get_size())
 
     def remove(self, component: "Component") -> None:
         self._children.remove(component)
+        component.parent = None
+        self._size -= component.get_size()
+        self._propagate(-component.get_size())
+
+    def iter_lines(self, tabs: int = 0) -> Iterator[str]:
+        yield space(tabs) + self.name + "\n"
+        # explicit stack instead of recursion, so the depth of the tree isn't limited
+        stack = [(iter(self._children), tabs + 1)]
+        while stack:
+            children, level = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                continue
+            yield space(level) + child.name + "\n"
+            if isinstance(child, Folder):
+                stack.append((iter(child._children), level + 1))
+
+
+def map_reduce(map_fn: Callable[[File], Any], combine_fn: Callable[[Any, Any], Any], initial: Any,
+               files: Iterator[File]) -> Any:
+    return reduce(combine_fn, map(map_fn, files), initial)
+
+
+def map_reduce_batch(map_fn: Callable[[File], Any], combine_fn: Callable[[Any, Any], Any],
+                     files: List[File]) -> Any:
+    # batches are never empty, so no initial value is needed
+    return reduce(combine_fn, map(map_fn, files))
+
+
+NO_NODE = -1
+
+
+class CompactNode:
+    """Lightweight handle of a CompactTree node with the same API as Component."""
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree: "CompactTree", index: int) -> None:
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, CompactNode) and other.tree is self.tree and other.index == self.index
+
+    def __hash__(self) -> int:
+        return hash((id(self.tree), self.index))
+
+    @property
+    def name(self) -> str:
+        return self.tree.get_name(self.index)
+
+    @property
+    def parent(self) -> Optional["CompactNode"]:
+        parent = self.tree.parents[self.index]
+        return None if parent == NO_NODE else CompactNode(self.tree, parent)
+
+    def is_composite(self) -> bool:
+        return bool(self.tree.is_folder[self.index])
+
+    def add(self, component: "CompactNode") -> None:
+        self._check_tree(component)
+        self.tree.attach(self.index, component.index)
+
+    def remove(self, component: "CompactNode") -> None:
+        self._check_tree(component)
+        self.tree.detach(self.index, component.index)
+
+    def _check_tree(self, component: "CompactNode") -> None:
+        # indexes are meaningful only within their own tree
+        if component.tree is not self.tree:
+            raise ValueError(f"{component.name} belongs to another tree")
+
+    def get_size(self) -> int:
+        return self.tree.subtree_sizes[self.index]
+
+    def iter_lines(self, tabs: int = 0) -> Iterator[str]:
+        return self.tree.iter_lines(self.index, tabs)
 
     def printify(self, tabs: int = 0) -> str:
-        res = space(tabs) + self.name + "\n"
-        for child in self._children:
-            res += child.printify(tabs + 1)
-        return res
+        return "".join(self.iter_lines(tabs))
+
+
+class CompactTree:
+    """
+    The whole tree in parallel arrays indexed by node: links to parent, first and last child and next
+    sibling, name offsets into a shared UTF-8 buffer and sizes. Removed nodes are only detached, their
+    slots aren't reused.
+    """
+
+    def __init__(self, root_name: str = "/") -> None:
+        self.parents = array("i")
+        self.first_children = array("i")
+        self.last_children = array("i")
+        self.next_siblings = array("i")
+        self.is_folder = bytearray()
+        # own size of the node and size of its whole subtree
+        self.sizes = array("q")
+        self.subtree_sizes = array("q")
+        self._names = bytearray()
+        self._name_offsets = array("Q", [0])
+        self.root = self.folder(root_name)
+
+    def _new_node(self, name: str, size: int, is_folder: bool) -> CompactNode:
+        index = len(self.parents)
+        for links in (self.parents, self.first_children, self.last_children, self.next_siblings):
+            links.append(NO_NODE)
+        self.is_folder.append(is_folder)
+        self.sizes.append(size)
+        self.subtree_sizes.append(size)
+        self._names += name.encode()
+        self._name_offsets.append(len(self._names))
+        return CompactNode(self, index)
+
+    def folder(self, name: str) -> CompactNode:
+        return self._new_node(name, 1, True)
+
+    def file(self, name: str, size: Optional[int] = None) -> CompactNode:
+        return self._new_node(name, len(name) if size is None else size, False)
+
+    def get_name(self, index: int) -> str:
+        return self._names[self._name_offsets[index]:self._name_offsets[index + 1]].decode()
+
+    def attach(self, parent: int, child: int) -> None:
+        if not self.is_folder[parent]:
+            return
+        node = parent
+        while node != NO_NODE:
+            if node == child:
+                raise ValueError(f"Can't attach {self.get_name(child)} into itself or its own descendant")
+            node = self.parents[node]
+        if self.parents[child] != NO_NODE:
+            self.detach(self.parents[child], child)
+        last = self.last_children[parent]
+        if last == NO_NODE:
+            self.first_children[parent] = child
+        else:
+            self.next_siblings[last] = child
+        self.last_children[parent] = child
+        self.parents[child] = parent
+        self._propagate(parent, self.subtree_sizes[child])
+
+    def detach(self, parent: int, child: int) -> None:
+        if self.parents[child] != parent:
+            raise ValueError(f"{self.get_name(child)} is not a child of {self.get_name(parent)}")
+        previous, node = NO_NODE, self.first_children[parent]
+        while node != child:
+            previous, node = node, self.next_siblings[node]
+        following = self.next_siblings[child]
+        if previous == NO_NODE:
+            self.first_children[parent] = following
+        else:
+            self.next_siblings[previous] = following
+        if self.last_children[parent] == child:
+            self.last_children[parent] = previous
+        self.parents[child] = self.next_siblings[child] = NO_NODE
+        self._propagate(parent, -self.subtree_sizes[child])
+
+    def resize(self, index: int, size: int) -> None:
+        delta = size - self.sizes[index]
+        self.sizes[index] = size
+        self._propagate(index, delta)
+
+    def _propagate(self, index: int, delta: int) -> None:
+        parents, subtree_sizes = self.parents, self.subtree_sizes
+        while index != NO_NODE:
+            subtree_sizes[index] += delta
+            index = parents[index]
+
+    def topological_order(self, index: Optional[int] = None) -> array:
+        """Breadth-first order of the subtree, every parent goes before its children."""
+        first_children, next_siblings = self.first_children, self.next_siblings
+        order = array("i", [self.root.index if index is None else index])
+        position = 0
+        while position < len(order):
+            child = first_children[order[position]]
+            while child != NO_NODE:
+                order.append(child)
+                child = next_siblings[child]
+            position += 1
+        return order
+
+    def rollup(self) -> array:
+        """Subtree sizes of every node from scratch, in one bottom-up pass over the ordered nodes."""
+        totals = array("q", self.sizes)
+        parents = self.parents
+        for index in reversed(self.topological_order()):
+            parent = parents[index]
+            if parent != NO_NODE:
+                totals[parent] += totals[index]
+        return totals
+
+    def check_consistency(self) -> bool:
+        totals = self.rollup()
+        return all(totals[index] == self.subtree_sizes[index] for index in self.topological_order())
+
+    def iter_lines(self, index: int, tabs: int = 0) -> Iterator[str]:
+        first_children, next_siblings = self.first_children, self.next_siblings
+        yield space(tabs) + self.get_name(index) + "\n"
+        stack = [(first_children[index], tabs + 1)]
+        while stack:
+            node, level = stack.pop()
+            if node == NO_NODE:
+                continue
+            yield space(level) + self.get_name(node) + "\n"
+            # the sibling is visited after the whole subtree of the node
+            stack.append((next_siblings[node], level))
+            stack.append((first_children[node], level + 1))
+
+
+def build_compact_tree(depth: int = 6, width: int = 6) -> CompactTree:
+    tree = CompactTree("/")
+    level = [tree.root]
+    for _ in range(depth - 1):
+        next_level = []
+        for folder in level:
+            for idx in range(width):
+                child = tree.folder(f"folder{idx}")
+                folder.add(child)
+                next_level.append(child)
+        level = next_level
+    for folder in level:
+        for idx in range(width):
+            folder.add(tree.file(f"file{idx}.txt"))
+    return tree
+
+
+def build_tree(depth: int = 6, width: int = 6) -> Folder:
+    root = Folder("/")
+    level = [root]
+    for _ in range(depth - 1):
+        next_level = []
+        for folder in level:
+            for idx in range(width):
+                child = Folder(f"folder{idx}")
+                folder.add(child)
+                next_level.append(child)
+        level = next_level
+    for folder in level:
+        for idx in range(width):
+            folder.add(File(f"file{idx}.txt"))
+    return root
+
+
+def benchmark(queries: int = 100) -> None:
+    root = build_tree()
+    leaf_folder = root
+    while isinstance(leaf_folder._children[0], Folder):
+        leaf_folder = leaf_folder._children[0]
+
+    def workload(get_size) -> None:
+        for idx in range(queries):
+            leaf_folder._children[0].resize(idx)
+            get_size()
+
+    for name, get_size in (("recursive", root.recompute_size), ("cached", root.get_size)):
+        elapsed = timeit.timeit(lambda: workload(get_size), number=1)
+        print(f"{name}: {elapsed / queries * 1e6:.1f}us per update and query")
+    assert root.check_consistency()
+
+    for name, build in (("objects", build_tree), ("compact", build_compact_tree)):
+        tracemalloc.start()
+        tree = build()
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name} tree: {memory / 1024 / 1024:.1f}MB")
+        del tree
+
+
+def checksum(file: File, rounds: int = 2000) -> int:
+    """CPU-bound work per file."""
+    digest = file.name.encode()
+    for _ in range(rounds):
+        digest = hashlib.sha256(digest).digest()
+    return digest[0]
+
+
+def benchmark_reduce(depth: int = 3, width: int = 8) -> None:
+    root = build_tree(depth, width)
+    started = timeit.default_timer()
+    expected = root.reduce(checksum, operator.add, 0)
+    sequential = timeit.default_timer() - started
+    print(f"sequential reduce over {sum(1 for _ in root.iter_files())} files: {sequential:.2f}s")
+
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            started = timeit.default_timer()
+            result = root.reduce(checksum, operator.add, 0, executor=executor, granularity=64)
+            elapsed = timeit.default_timer() - started
+        assert result == expected
+        print(f"{workers} processes: {elapsed:.2f}s, speedup {sequential / elapsed:.1f}x")
+        workers *= 2
 
 
 if __name__ == "__main__":
@@ -90,3 +492,32 @@ if __name__ == "__main__":
     print(f"Size of root {root.get_size()}")
     log.remove(log_file)
     print(f"Updated size of root {root.get_size()}")
+    assert root.check_consistency()
+    benchmark()
+
+    deep_root = node = Folder("deep")
+    for idx in range(5000):
+        child = Folder(f"level{idx}")
+        node.add(child)
+        node = child
+    with open(os.devnull, "w") as devnull:
+        deep_root.write_to(devnull)
+    print(f"Streamed {sum(1 for _ in deep_root.iter_lines())} lines of a 5000 levels deep tree")
+
+    tree = CompactTree("/")
+    tree.root.add(tree.file("hello.txt"))
+    var = tree.folder("var")
+    log = tree.folder("log")
+    log_file = tree.file("pacman.log")
+    log.add(log_file)
+    log.add(tree.file(".env"))
+    var.add(log)
+    tree.root.add(var)
+    print(tree.root.printify())
+    print(f"Size of compact root {tree.root.get_size()}")
+    log.remove(log_file)
+    print(f"Updated size of compact root {tree.root.get_size()}")
+    assert tree.check_consistency()
+
+    print(f"Size of files in root {root.reduce(File.get_size, operator.add, 0)}")
+    benchmark_reduce()
@@ -2,7 +2,12 @@
 Decorator allows adding new behaviors to objects dynamically by placing them inside special wrapper objects, called decorators.
 
 """
-from typing import Protocol
+import threading
+import time
+import timeit
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Protocol, Tuple
 
 
 class Speechable(Protocol):
@@ -22,13 +27,130 @@ class SpeechableDecorator:
         self.sayer = sayer
 
     def say(self) -> str:
-        return f"Mega {self.sayer.say()}"
+        return self.decorate(self.sayer.say())
+
+    def decorate(self, word: str) -> str:
+        """Pure transformation of the wrapped result, lets ``flatten`` skip the chain of ``say`` calls."""
+        return f"Mega {word}"
+
+
+class CachingDecorator:
+    """
+    Memoizes ``say`` of the wrapped object, and the other ``methods`` named explicitly, the rest of
+    its attributes pass through untouched. Keeps at most ``max_size`` results for ``ttl`` seconds,
+    and concurrent callers of a missing result wait for a single computation.
+    """
+
+    def __init__(
+        self, sayer: Speechable, max_size: int = 128, ttl: Optional[float] = None, methods: Iterable[str] = ()
+    ) -> None:
+        self.sayer = sayer
+        self._methods = frozenset(methods)
+        self._max_size = max_size
+        self._ttl = ttl
+        self._cache: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def say(self) -> str:
+        return self._get(("say", ()), self.sayer.say)
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.sayer, name)
+        if name not in self._methods:
+            # only methods known to be pure are memoized
+            return attr
+        return lambda *args, **kwargs: self._get(self._key(name, args, kwargs), lambda: attr(*args, **kwargs))
+
+    @staticmethod
+    def _key(method: str, args: Tuple[Hashable, ...], kwargs: Dict[str, Hashable]) -> Hashable:
+        return (method, args, tuple(sorted(kwargs.items()))) if kwargs else (method, args)
+
+    def invalidate(self, method: Optional[str] = None, *args: Hashable, **kwargs: Hashable) -> None:
+        with self._lock:
+            # computations already running are forgotten too, their results won't be cached
+            if method is None:
+                self._cache.clear()
+                self._in_flight.clear()
+            else:
+                key = self._key(method, args, kwargs)
+                self._cache.pop(key, None)
+                self._in_flight.pop(key, None)
+
+    def _get(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and (self._ttl is None or time.monotonic() - cached[0] < self._ttl):
+                self._cache.move_to_end(key)
+                return cached[1]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = compute()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            with self._lock:
+                # invalidated while computing, the result may be outdated already
+                if self._in_flight.get(key) is future:
+                    self._cache[key] = (time.monotonic(), result)
+                    self._cache.move_to_end(key)
+                    while len(self._cache) > self._max_size:
+                        self._cache.popitem(last=False)
+            return result
+        finally:
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+
+
+def flatten(sayer: Speechable) -> Callable[[], str]:
+    """
+    Compile a stack of pure decorators into one callable, that applies them in a loop. A decorator
+    overriding ``say`` can't be expressed by ``decorate``, so flattening stops there and calls it.
+    """
+    transforms: List[Callable[[str], str]] = []
+    while isinstance(sayer, SpeechableDecorator) and type(sayer).say is SpeechableDecorator.say:
+        transforms.append(sayer.decorate)
+        sayer = sayer.sayer
+    transforms.reverse()
+    base = sayer.say
+
+    def say() -> str:
+        word = base()
+        for transform in transforms:
+            word = transform(word)
+        return word
+
+    return say
 
 
 def say_word(sayer: Speechable) -> None:
     print(f"Word is '{sayer.say()}'")
 
 
+def benchmark(depth: int = 50, number: int = 20_000) -> None:
+    sayer: Speechable = Cat()
+    for _ in range(depth):
+        sayer = SpeechableDecorator(sayer)
+
+    for name, say in (
+        ("decorator chain", sayer.say),
+        ("flattened", flatten(sayer)),
+        ("cached", CachingDecorator(sayer).say),
+    ):
+        elapsed = timeit.timeit(say, number=number)
+        print(f"{name} of {depth} decorators: {elapsed / number * 1e6:.2f}us per call")
+
+
 if __name__ == "__main__":
     cat = Cat()
     say_word(cat)
@@ -38,3 +160,10 @@ if __name__ == "__main__":
 
     decoratorForDecorator = SpeechableDecorator(decorator)
     say_word(decoratorForDecorator)
+
+    cached = CachingDecorator(decoratorForDecorator, ttl=60)
+    say_word(cached)
+    cached.invalidate("say")
+    say_word(cached)
+    print(f"Flattened: '{flatten(decoratorForDecorator)()}'")
+    benchmark()
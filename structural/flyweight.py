@@ -2,58 +2,420 @@
 Flyweight lets you fit more objects into the available amount of RAM by sharing common parts of
 state between multiple objects instead of keeping all the data in each object.
 """
+import csv
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from itertools import accumulate, islice
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 Data = dict
+Resident = Tuple[str, str]
 
 
-@dataclass
+@dataclass(slots=True, weakref_slot=True)
 class City:
     name: str
     # ...
     # image, map or anything that take a lot of RAM
 
+    def __post_init__(self) -> None:
+        self.name = sys.intern(self.name)
 
-class CityFactory:
-    _cities: Dict[str, City] = {}
 
-    def __init__(self, initial_cities: List[City]) -> None:
-        for city in initial_cities:
-            self._cities[city.name] = city
+@dataclass(frozen=True)
+class CacheStats:
+    size: int
+    hits: int
+    misses: int
+    evictions: int
 
-    @classmethod
-    def get_city(cls, name: str) -> City:
-        city = cls._cities.get(name)
+
+class CityCache(ABC):
+    """Storage of shared cities, not thread-safe unless wrapped into StripedCache."""
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @abstractmethod
+    def _get(self, name: str) -> Optional[City]:
+        ...
+
+    @abstractmethod
+    def put(self, city: City) -> None:
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[City]:
+        ...
+
+    def get_or_create(self, name: str) -> City:
+        city = self._get(name)
         if city is None:
-            cls._cities[name] = city = City(name)
+            self.misses += 1
+            city = City(name)
+            self.put(city)
+        else:
+            self.hits += 1
         return city
 
+    def stats(self) -> CacheStats:
+        return CacheStats(len(self), self.hits, self.misses, self.evictions)
+
+
+class DictCache(CityCache):
+    """Keeps every city forever."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._cities: Dict[str, City] = {}
+
+    def _get(self, name: str) -> Optional[City]:
+        return self._cities.get(name)
+
+    def put(self, city: City) -> None:
+        self._cities[city.name] = city
+
+    def __len__(self) -> int:
+        return len(self._cities)
+
+    def __iter__(self) -> Iterator[City]:
+        return iter(list(self._cities.values()))
+
+
+class LRUCache(CityCache):
+    """Keeps at most ``max_size`` cities, the least recently used one is dropped first."""
+
+    def __init__(self, max_size: int = 1024) -> None:
+        super().__init__()
+        self._max_size = max_size
+        self._cities: OrderedDict[str, City] = OrderedDict()
+
+    def _get(self, name: str) -> Optional[City]:
+        city = self._cities.get(name)
+        if city is not None:
+            self._cities.move_to_end(name)
+        return city
+
+    def put(self, city: City) -> None:
+        self._cities[city.name] = city
+        self._cities.move_to_end(city.name)
+        while len(self._cities) > self._max_size:
+            self._cities.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._cities)
+
+    def __iter__(self) -> Iterator[City]:
+        return iter(list(self._cities.values()))
+
+
+class WeakCache(CityCache):
+    """Keeps a city only while some user still references it."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._cities: weakref.WeakValueDictionary[str, City] = weakref.WeakValueDictionary()
+        self._stored = 0
+
+    def _get(self, name: str) -> Optional[City]:
+        return self._cities.get(name)
+
+    def put(self, city: City) -> None:
+        if city.name not in self._cities:
+            self._stored += 1
+        self._cities[city.name] = city
+
+    def __len__(self) -> int:
+        return len(self._cities)
+
+    def __iter__(self) -> Iterator[City]:
+        return iter(list(self._cities.values()))
+
+    def stats(self) -> CacheStats:
+        # the garbage collector drops cities silently, so evictions are whatever is gone
+        size = len(self)
+        return CacheStats(size, self.hits, self.misses, self._stored - size)
+
+
+class StripedCache(CityCache):
+    """Splits names between ``stripes`` caches with their own locks, so threads rarely contend."""
+
+    def __init__(self, make_cache: Callable[[], CityCache] = DictCache, stripes: int = 16) -> None:
+        super().__init__()
+        self._stripes = [(threading.Lock(), make_cache()) for _ in range(stripes)]
+
+    def _stripe(self, name: str) -> Tuple[threading.Lock, CityCache]:
+        return self._stripes[hash(name) % len(self._stripes)]
+
+    def _get(self, name: str) -> Optional[City]:
+        lock, cache = self._stripe(name)
+        with lock:
+            return cache._get(name)
+
+    def get_or_create(self, name: str) -> City:
+        lock, cache = self._stripe(name)
+        with lock:
+            return cache.get_or_create(name)
+
+    def put(self, city: City) -> None:
+        lock, cache = self._stripe(city.name)
+        with lock:
+            cache.put(city)
+
+    def __len__(self) -> int:
+        return sum(len(cache) for _, cache in self._stripes)
+
+    def __iter__(self) -> Iterator[City]:
+        for lock, cache in self._stripes:
+            with lock:
+                cities = list(cache)
+            yield from cities
+
+    def stats(self) -> CacheStats:
+        stats = [cache.stats() for _, cache in self._stripes]
+        return CacheStats(
+            size=sum(item.size for item in stats),
+            hits=sum(item.hits for item in stats),
+            misses=sum(item.misses for item in stats),
+            evictions=sum(item.evictions for item in stats),
+        )
+
+
+class CityFactory:
+
+    def __init__(self, initial_cities: Iterable[City] = (), cache: Optional[CityCache] = None) -> None:
+        self._cities = DictCache() if cache is None else cache
+        for city in initial_cities:
+            self._cities.put(city)
+
+    def get_city(self, name: str) -> City:
+        return self._cities.get_or_create(name)
+
+    def stats(self) -> CacheStats:
+        return self._cities.stats()
+
     def list_cache(self) -> None:
-        print(self._cities)
+        print(list(self._cities))
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
     full_name: str
     city: City
 
 
+def chunked(residents: Iterable[Resident], chunk_size: int) -> Iterator[List[Resident]]:
+    iterator = iter(residents)
+    while chunk := list(islice(iterator, chunk_size)):
+        yield chunk
+
+
+def read_csv(path: str, chunk_size: int, skip_header: bool = True) -> Iterator[List[Resident]]:
+    """Stream "full_name,city" rows, only one chunk of them is kept in memory at a time."""
+    with open(path, newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        row_number = 0
+        if skip_header:
+            next(reader, None)
+            row_number += 1
+        for chunk in chunked(reader, chunk_size):
+            first_row = row_number + 1
+            row_number += len(chunk)
+            # one pass in C for the usual case, rows are checked one by one only when something is off
+            if set(map(len, chunk)) != {2}:
+                chunk = _valid_rows(path, chunk, first_row)
+                if not chunk:
+                    continue
+            yield chunk
+
+
+def _valid_rows(path: str, chunk: List[List[str]], first_row: int) -> List[List[str]]:
+    rows = []
+    for row_number, row in enumerate(chunk, first_row):
+        if not row:
+            # blank line
+            continue
+        if len(row) != 2:
+            raise ValueError(f"{path}, row {row_number}: expected 2 fields (full_name,city), got {len(row)}")
+        rows.append(row)
+    return rows
+
+
 class Citizens:
-    def __init__(self) -> None:
+    def __init__(self, factory: Optional[CityFactory] = None) -> None:
+        self.factory = CityFactory() if factory is None else factory
         self.users: List[User] = []
 
     def add_resident(self, username: str, city: str) -> None:
-        city = CityFactory.get_city(city)
+        city = self.factory.get_city(city)
         user = User(username, city)
         self.users.append(user)
 
+    def add_residents(self, residents: Iterable[Resident], chunk_size: int = 65536) -> None:
+        for chunk in chunked(residents, chunk_size):
+            self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk: List[Resident]) -> None:
+        # one factory lookup per distinct city instead of one per resident
+        usernames, city_names = zip(*chunk)
+        get_city = self.factory.get_city
+        cities = {name: get_city(name) for name in set(city_names)}
+        self.users.extend(map(User, usernames, map(cities.__getitem__, city_names)))
+
+    @classmethod
+    def from_csv(
+        cls, path: str, chunk_size: int = 65536, factory: Optional[CityFactory] = None
+    ) -> "Citizens":
+        citizens = cls(factory)
+        for chunk in read_csv(path, chunk_size):
+            citizens._add_chunk(chunk)
+        return citizens
+
+
+class CompactCitizens:
+    """
+    Stores residents column-wise: all names in one UTF-8 buffer and a city index per resident
+    pointing into the table of shared cities. User objects are built only while iterating.
+    """
+
+    def __init__(self, factory: Optional[CityFactory] = None) -> None:
+        self.factory = CityFactory() if factory is None else factory
+        self._names = bytearray()
+        self._name_ends = array("Q")
+        self._city_ids = array("I")
+        self._cities: List[City] = []
+        self._city_index: Dict[str, int] = {}
+
+    def add_resident(self, username: str, city: str) -> None:
+        city_id = self._city_index.get(city)
+        if city_id is None:
+            city_id = self._city_index[city] = len(self._cities)
+            self._cities.append(self.factory.get_city(city))
+        self._names += username.encode()
+        self._name_ends.append(len(self._names))
+        self._city_ids.append(city_id)
+
+    def add_residents(self, residents: Iterable[Resident], chunk_size: int = 65536) -> None:
+        for chunk in chunked(residents, chunk_size):
+            self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk: List[Resident]) -> None:
+        usernames, city_names = zip(*chunk)
+        city_index = self._city_index
+        for city in set(city_names):
+            if city not in city_index:
+                city_index[city] = len(self._cities)
+                self._cities.append(self.factory.get_city(city))
+
+        encoded = list(map(str.encode, usernames))
+        ends = accumulate(map(len, encoded), initial=len(self._names))
+        next(ends)
+        self._name_ends.extend(ends)
+        self._names += b"".join(encoded)
+        self._city_ids.extend(map(city_index.__getitem__, city_names))
+
+    @classmethod
+    def from_csv(
+        cls, path: str, chunk_size: int = 65536, factory: Optional[CityFactory] = None
+    ) -> "CompactCitizens":
+        citizens = cls(factory)
+        for chunk in read_csv(path, chunk_size):
+            citizens._add_chunk(chunk)
+        return citizens
+
+    def __len__(self) -> int:
+        return len(self._city_ids)
+
+    def __getitem__(self, idx: int) -> User:
+        if idx < 0:
+            idx += len(self)
+            if idx < 0:
+                raise IndexError("CompactCitizens index out of range")
+        start = self._name_ends[idx - 1] if idx else 0
+        name = self._names[start:self._name_ends[idx]].decode()
+        return User(name, self._cities[self._city_ids[idx]])
+
+    def __iter__(self) -> Iterator[User]:
+        names, cities = self._names, self._cities
+        start = 0
+        for end, city_id in zip(self._name_ends, self._city_ids):
+            yield User(names[start:end].decode(), cities[city_id])
+            start = end
+
+
+def benchmark(residents: int = 200_000, cities: int = 1000) -> None:
+    for citizens_class in (Citizens, CompactCitizens):
+        tracemalloc.start()
+        citizens = citizens_class(CityFactory())
+        for idx in range(residents):
+            citizens.add_resident(f"Resident {idx}", f"City {idx % cities}")
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{citizens_class.__name__}: {size / residents:.1f} bytes per resident")
+
+
+def benchmark_csv(rows: int = 1_000_000, cities: int = 1000) -> None:
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(("full_name", "city"))
+        writer.writerows((f"Resident {idx}", f"City {idx % cities}") for idx in range(rows))
+    try:
+        for citizens_class in (Citizens, CompactCitizens):
+            started = time.perf_counter()
+            citizens = citizens_class.from_csv(file.name)
+            elapsed = time.perf_counter() - started
+            print(f"{citizens_class.__name__}.from_csv: {rows / elapsed:,.0f} rows/s")
+            del citizens
+    finally:
+        os.remove(file.name)
+
 
 if __name__ == "__main__":
     factory = CityFactory([City("New York"), City("Atlanta"), City("Los Angeles")])
-    usa_citizens = Citizens()
+    usa_citizens = Citizens(factory)
     usa_citizens.add_resident("John Doe", "Atlanta")
     usa_citizens.add_resident("Kevin Brown", "Washington")
     usa_citizens.add_resident("Isaak Newton", "Washington")
     print(usa_citizens.__dict__)
     factory.list_cache()
+    print(factory.stats())
+
+    lru_factory = CityFactory(cache=StripedCache(lambda: LRUCache(max_size=64), stripes=16))
+    threads = [
+        threading.Thread(target=lambda: [lru_factory.get_city(f"City {idx % 5000}") for idx in range(20_000)])
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"LRU: {lru_factory.stats()}")
+
+    weak_citizens = Citizens(CityFactory(cache=WeakCache()))
+    for idx in range(1000):
+        weak_citizens.add_resident(f"User {idx}", f"City {idx % 100}")
+    weak_citizens.users.clear()
+    print(f"Weak: {weak_citizens.factory.stats()}")
+
+    compact_citizens = CompactCitizens(factory)
+    compact_citizens.add_resident("John Doe", "Atlanta")
+    compact_citizens.add_resident("Kevin Brown", "Washington")
+    print(list(compact_citizens))
+    benchmark()
+    benchmark_csv()
@@ -3,7 +3,19 @@ Proxy lets you provide a substitute or placeholder for another object. A proxy c
 the original object, allowing you to perform something either before or after the request gets
 through to the original object.
 """
-from typing import Optional
+import asyncio
+import mmap
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+CHUNK_SIZE = 1024 * 1024
+
+# bounded pool shared by all prefetching proxies
+loader_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="prefetch")
 
 
 class TextFile:
@@ -36,9 +48,179 @@ class Proxy(TextFile):
         self._subject.display()
 
 
+class FileMapping:
+    """Read-only contents of a file, memory-mapped when possible, remembers which file version it holds."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as file:
+            self.version = self._version(os.fstat(file.fileno()))
+            try:
+                self.buffer: Union[mmap.mmap, bytearray] = mmap.mmap(
+                    file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except (ValueError, OSError):
+                # empty and special files (i.e. procfs) can't be mapped
+                self.buffer = self._read_chunks(file)
+        self.view = memoryview(self.buffer)
+
+    @staticmethod
+    def _version(stat: os.stat_result) -> Tuple[int, int, int]:
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _read_chunks(file) -> bytearray:
+        buffer = bytearray()
+        while chunk := file.read(CHUNK_SIZE):
+            buffer += chunk
+        return buffer
+
+    def is_stale(self) -> bool:
+        try:
+            return self._version(os.stat(self.path)) != self.version
+        except FileNotFoundError:
+            return True
+
+
+# one mapping per file for the whole process, shared by all proxies
+_mappings: Dict[str, FileMapping] = {}
+_mappings_lock = threading.Lock()
+
+
+def get_mapping(path: str) -> FileMapping:
+    key = os.path.realpath(path)
+    with _mappings_lock:
+        mapping = _mappings.get(key)
+        if mapping is None or mapping.is_stale():
+            # the old mapping is closed once the last view of it is gone
+            print("Mapping the file!")
+            mapping = _mappings[key] = FileMapping(key)
+        return mapping
+
+
+class CachingProxy(TextFile):
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def display(self) -> None:
+        view = get_mapping(self.path).view
+        buffer = getattr(sys.stdout, "buffer", None)
+        if buffer is None:
+            # text-only stream (i.e. StringIO), the bytes have to be decoded
+            print(str(view, "utf-8", "replace"))
+            return
+        sys.stdout.flush()
+        buffer.write(view)
+        buffer.write(b"\n")
+        buffer.flush()
+
+    def read_range(self, offset: int, length: int) -> memoryview:
+        return get_mapping(self.path).view[offset:offset + length]
+
+    def iter_lines(self) -> Iterator[memoryview]:
+        mapping = get_mapping(self.path)
+        buffer, view = mapping.buffer, mapping.view
+        start = 0
+        while start < len(view):
+            end = buffer.find(b"\n", start)
+            end = len(view) if end == -1 else end + 1
+            yield view[start:end]
+            start = end
+
+
+class PrefetchingProxy(TextFile):
+
+    def __init__(self, path: str, prefetch: bool = False, executor: Executor = loader_pool) -> None:
+        self.path = path
+        self._executor = executor
+        self._future: Optional[Future] = None
+        self._lock = threading.Lock()
+        if prefetch:
+            self.prefetch()
+
+    def prefetch(self) -> None:
+        """Hint that the file will be needed soon, it's loaded in the background."""
+        with self._lock:
+            if self._future is None:
+                self._future = self._executor.submit(TextFile, self.path)
+
+    def display(self) -> None:
+        with self._lock:
+            future = self._future
+            owner = future is None
+            if owner:
+                future = self._future = Future()
+
+        if owner:
+            # nobody asked to prefetch, load in the current thread instead of queueing behind others
+            try:
+                future.set_result(TextFile(self.path))
+            except BaseException as exc:
+                future.set_exception(exc)
+        # every caller waits for the same load
+        future.result().display()
+
+
+class AsyncPrefetchingProxy(TextFile):
+
+    def __init__(self, path: str, executor: Executor = loader_pool) -> None:
+        self.path = path
+        self._executor = executor
+        self._task: Optional[asyncio.Future] = None
+
+    def prefetch(self) -> asyncio.Future:
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            self._task = loop.run_in_executor(self._executor, TextFile, self.path)
+        return self._task
+
+    async def display(self) -> None:
+        subject = await self.prefetch()
+        subject.display()
+
+
+async def warm_up(paths: List[str]) -> List[AsyncPrefetchingProxy]:
+    """Load all the files concurrently, the returned proxies display them without touching the disk."""
+    proxies = [AsyncPrefetchingProxy(path) for path in paths]
+    await asyncio.gather(*(proxy.prefetch() for proxy in proxies))
+    return proxies
+
+
+async def async_main(paths: List[str]) -> None:
+    proxies = await warm_up(paths)
+    for proxy in proxies:
+        await proxy.display()
+
+
 if __name__ == "__main__":
     proxy = Proxy("/etc/os-release")
     print(proxy.path)
     # read only once
     proxy.display()
     proxy.display()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file:
+        file.write("first line\nsecond line\n")
+    try:
+        caching_proxy = CachingProxy(file.name)
+        another_proxy = CachingProxy(file.name)
+        caching_proxy.display()
+        # shares the mapping with the first proxy
+        print(bytes(another_proxy.read_range(6, 4)))
+        with open(file.name, "a") as changed:
+            changed.write("third line\n")
+        # the file has changed, so it's mapped again
+        print([bytes(line) for line in caching_proxy.iter_lines()])
+
+        prefetching_proxy = PrefetchingProxy(file.name, prefetch=True)
+        # both threads wait for the load started on construction
+        threads = [threading.Thread(target=prefetching_proxy.display) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        asyncio.run(async_main([file.name, "/etc/os-release"]))
+    finally:
+        os.remove(file.name)